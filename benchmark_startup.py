@@ -0,0 +1,45 @@
+#Measures how long the entry points take to start, for scripts that shell out to them many times
+#Each command runs in a fresh python process, so nothing is already imported or cached in memory
+#
+#    python benchmark_startup.py
+#    python benchmark_startup.py --repeats=10
+
+import os
+import sys
+import time
+import subprocess
+import statistics
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+commands = dict(
+    import_inference    = [sys.executable, "-c", "import cut_and_drag_inference"],
+    import_gui          = [sys.executable, "-c", "import cut_and_drag_gui"],
+    inference_help      = [sys.executable, "cut_and_drag_inference.py", "--help"],
+    inference_dry_run   = [sys.executable, "cut_and_drag_inference.py", "README.md", "benchmark_startup_dry_run.mp4", "--degradation=[.3,.5,.7]", "--dry_run"],
+    inference_bad_args  = [sys.executable, "cut_and_drag_inference.py", "missing_sample.pkl", "benchmark_startup_bad_args.mp4"],
+    warped_noise_help   = [sys.executable, "make_warped_noise.py", "--help"],
+    #For comparison: what every invocation used to pay up front
+    import_heavy_deps   = [sys.executable, "-c", "import torch, diffusers, transformers, einops, icecream"],
+)
+
+
+def time_command(command, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=dict(os.environ, PAGER="cat"))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main(repeats=5):
+    print(f"{'command':20}  {'median':>8}  {'min':>8}  {'max':>8}")
+    for name, command in commands.items():
+        times = time_command(command, repeats)
+        print(f"{name:20}  {statistics.median(times):7.2f}s  {min(times):7.2f}s  {max(times):7.2f}s")
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,300 @@
+#Measures end-to-end sweep throughput (jobs/hour) offline, on a CPU, without downloading any checkpoints
+#It saves a randomly initialized miniature CogVideoX stack (transformer, VAE, T5) with the same interfaces as the real one,
+#registers it as a pipe in cut_and_drag_inference, then runs get_pipe -> load_sample_cartridge -> run_pipe over a synthetic sweep.
+#The videos are noise, but every stage around the models (loading, caching, decoding, post-processing) does its real work,
+#so this is for comparing changes to those stages - not for judging model speed.
+#
+#    python benchmark_throughput.py
+#    python benchmark_throughput.py --num_samples=3 --degradations='[.3,.5,.7]' --num_inference_steps=10 --step_reuse=.1
+#    python benchmark_throughput.py --workers=2    #Runs the sweep through run_sweep_parallel, with 2 CPU worker processes
+
+import json
+import functools
+import time
+import itertools
+import contextlib
+from collections import defaultdict
+
+import numpy as np
+import rp
+
+import cut_and_drag_inference as inference
+from cut_and_drag_inference import torch, diffusers, transformers
+
+
+def make_tiny_checkpoint(folder, is_i2v=True, seed=0):
+    """
+    Saves a randomly initialized miniature CogVideoX pipeline to folder in diffusers' format, and returns folder
+    The shapes that cartridges and get_pipe depend on match the real models: 16 latent channels, 13x60x90 latents, 49x480x720 videos
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    torch.manual_seed(seed)
+
+    tokenizer = Tokenizer(models.WordLevel({"<pad>": 0, "</s>": 1, "<unk>": 2}, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>", unk_token="<unk>")
+
+    text_encoder = transformers.T5EncoderModel(
+        transformers.T5Config(vocab_size=8, d_model=16, d_kv=4, d_ff=32, num_layers=1, num_heads=2)
+    )
+    vae = diffusers.AutoencoderKLCogVideoX(
+        block_out_channels=(8, 8, 8, 8),
+        latent_channels=inference.C,
+        layers_per_block=1,
+        norm_num_groups=4,
+        temporal_compression_ratio=4,
+        sample_height=inference.H * 8,
+        sample_width=inference.W * 8,
+    )
+    transformer = diffusers.CogVideoXTransformer3DModel(
+        num_attention_heads=2,
+        attention_head_dim=16,
+        in_channels=inference.C * 2 if is_i2v else inference.C, #I2V models also take the image latents
+        out_channels=inference.C,
+        time_embed_dim=8,
+        text_embed_dim=16,
+        num_layers=1,
+        sample_width=inference.W,
+        sample_height=inference.H,
+        sample_frames=inference.num_frames,
+        patch_size=2,
+        temporal_compression_ratio=4,
+        max_text_seq_length=226,
+        use_rotary_positional_embeddings=True,
+        use_learned_positional_embeddings=is_i2v,
+    )
+    scheduler = diffusers.CogVideoXDPMScheduler(
+        beta_schedule="scaled_linear",
+        beta_start=0.00085,
+        beta_end=0.012,
+        clip_sample=False,
+        prediction_type="v_prediction",
+        rescale_betas_zero_snr=True,
+        set_alpha_to_one=True,
+        timestep_spacing="trailing",
+    )
+
+    PipeClass = diffusers.CogVideoXImageToVideoPipeline if is_i2v else diffusers.CogVideoXPipeline
+    pipe = PipeClass(tokenizer=tokenizer, text_encoder=text_encoder, vae=vae, transformer=transformer, scheduler=scheduler)
+    pipe.save_pretrained(folder)
+    return folder
+
+
+def make_synthetic_samples(folder, num_samples, seed=0):
+    """
+    Makes num_samples cartridge folders like make_warped_noise.py's (input.mp4 plus noise) and returns their paths
+    The noise is saved in the memory-mapped bfloat16 format, and the videos are smooth color gradients that drift over time
+    """
+    rng = np.random.default_rng(seed)
+    sample_paths = []
+    for index in range(num_samples):
+        sample_path = rp.path_join(folder, f"sample_{index}")
+        if not rp.folder_exists(sample_path):
+            noise = torch.from_numpy(rng.standard_normal((inference.num_frames, inference.C, inference.H, inference.W), dtype=np.float32))
+            inference.save_noise_file(noise, sample_path, "bfloat16")
+
+            y, x = np.mgrid[0 : inference.H * 8, 0 : inference.W * 8] / (inference.H * 8)
+            phases = rng.uniform(0, 2 * np.pi, 3)
+            video = [
+                np.stack([np.sin(x * 3 + y * 2 + t / 8 + phase) for phase in phases], axis=-1) / 2 + 0.5
+                for t in range(inference.num_frames)
+            ]
+            rp.save_video_mp4(video, rp.path_join(sample_path, "input.mp4"), framerate=12, video_bitrate="max", show_progress=False)
+        sample_paths.append(sample_path)
+    return sample_paths
+
+
+@contextlib.contextmanager
+def timed_calls(stage_seconds, targets):
+    """
+    While active, every call to the given (owner, attribute_name, stage) targets adds its duration to stage_seconds[stage]
+    Methods are patched on their class, so they stay timed through the per-call patches that run_pipe puts on instances
+    """
+    originals = [(owner, name, owner.__dict__[name]) for owner, name, _ in targets]
+
+    def timed(function, stage):
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage_seconds[stage] += time.perf_counter() - start_time
+        return wrapper
+
+    for owner, name, stage in targets:
+        setattr(owner, name, timed(getattr(owner, name), stage))
+    try:
+        yield
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+
+def tiny_pipe_factory(checkpoint_folder, model_name, device, memory_profile=None, **kwargs):
+    #For run_sweep_parallel's pipe_factory. Workers are spawned and re-import cut_and_drag_inference, so each one registers the checkpoint again
+    #It's bound to checkpoint_folder with functools.partial, which keeps it picklable
+    inference.pipe_ids[model_name] = checkpoint_folder
+    return inference.get_pipe(model_name, device, memory_profile=memory_profile or "full")
+
+
+def run_serial(pipe_name, jobs_kwargs, device, memory_profile, previews, run_folder):
+    #Runs the jobs one after another in this process, timing every stage. Returns (stage_seconds, stages, total_seconds, startup_seconds)
+    stage_seconds = defaultdict(float)
+
+    start_time = time.perf_counter()
+    pipe = inference.get_pipe(pipe_name, device, memory_profile=memory_profile)
+    startup_seconds = time.perf_counter() - start_time
+
+    vae_class = type(pipe.vae)
+    targets = [
+        (type(pipe.text_encoder), "forward", "text_encoder"),
+        (type(pipe.transformer), "forward", "transformer"),
+        (vae_class, "encode", "vae_encode"),
+        (vae_class, "decode", "vae_decode"),
+        (diffusers.utils, "export_to_video", "export_mp4"),
+        (inference, "make_labeled_preview", "previews"),
+        (rp, "save_video_mp4", "previews"),
+        (rp, "convert_to_gif_via_ffmpeg", "previews"),
+    ]
+
+    job_seconds = []
+    for index, kwargs in enumerate(jobs_kwargs):
+        rp.fansi_print(f"BENCHMARK JOB {index + 1}/{len(jobs_kwargs)}: sample_path={kwargs['sample_path']} degradation={kwargs['degradation']}", "cyan", "bold")
+        job_start_time = time.perf_counter()
+
+        start_time = time.perf_counter()
+        cartridge = inference.load_sample_cartridge(**kwargs)
+        stage_seconds["load_cartridge"] += time.perf_counter() - start_time
+
+        with timed_calls(stage_seconds, targets):
+            inference.run_pipe(pipe, cartridge, output_mp4_path=rp.path_join(run_folder, f"job_{index}.mp4"), save_previews=previews)
+
+        job_seconds.append(time.perf_counter() - job_start_time)
+
+    #Everything run_pipe did that wasn't one of the timed stages: scheduler steps, latent prep, moving tensors around...
+    timed_stages = rp.unique([stage for _, _, stage in targets])
+    total_seconds = sum(job_seconds)
+    stage_seconds["run_pipe_other"] = total_seconds - stage_seconds["load_cartridge"] - sum(stage_seconds[stage] for stage in timed_stages)
+
+    return stage_seconds, ["load_cartridge", *timed_stages, "run_pipe_other"], total_seconds, startup_seconds
+
+
+def run_workers(pipe_name, checkpoint_folder, jobs_kwargs, devices, memory_profile, previews, run_folder):
+    """
+    Runs the jobs through run_sweep_parallel, with one worker process per entry in devices, each loading its own tiny pipe
+    Stages can't be patched inside the workers, so the breakdown is the manifest's load and run times, summed over all workers
+    The total is wall-clock time, including every worker's startup. Returns (stage_seconds, stages, total_seconds, startup_seconds=None)
+    """
+    jobs = inference.get_sweep_jobs(jobs_kwargs, pipe_name)
+    manifest = rp.as_easydict(jobs={job.job_id: rp.as_easydict(params=job.params, status="pending") for job in jobs})
+    manifest_path = rp.path_join(run_folder, "manifest.json")
+
+    start_time = time.perf_counter()
+    inference.run_sweep_parallel(
+        jobs,
+        manifest,
+        manifest_path,
+        rp.path_join(run_folder, "sweep.mp4"),
+        len(jobs),
+        pipe_name,
+        devices,
+        memory_profile=memory_profile,
+        pipe_factory=functools.partial(tiny_pipe_factory, checkpoint_folder),
+        run_pipe_kwargs=dict(save_previews=previews),
+    )
+    total_seconds = time.perf_counter() - start_time
+
+    stage_seconds = dict(
+        load_cartridge=sum(entry.load_seconds for entry in manifest.jobs.values()),
+        run_pipe=sum(entry.run_seconds for entry in manifest.jobs.values()),
+    )
+    return stage_seconds, list(stage_seconds), total_seconds, None
+
+
+def main(
+    num_samples=2,
+    degradations=(0.3, 0.7),
+    num_inference_steps=4,
+    is_i2v=True,
+    step_reuse=0,
+    previews=True,
+    device="cpu",
+    memory_profile="full",
+    workers=None,
+    benchmark_folder="benchmark_throughput",
+):
+    """
+    Runs a num_samples x degradations sweep with the miniature models and prints jobs/hour with a per-stage breakdown
+    Checkpoints and samples are made once and reused by later runs. Each run writes its videos to a fresh folder in benchmark_folder.
+    Results are also saved as JSON next to the videos.
+    If workers is given, the sweep goes through run_sweep_parallel instead, with that many worker processes on device
+    (or a list of devices, one worker each) - the same scheduler main uses with --devices or --num_workers
+    Every untiled 480x720 decode needs a few GB of RAM, so with several CPU workers --memory_profile=full_tiled may be needed to fit
+    """
+    run_folder = rp.get_unique_copy_path(rp.path_join(benchmark_folder, "runs", time.strftime("%Y%m%d_%H%M%S")))
+    rp.make_directory(run_folder)
+
+    #Setup. Not part of the throughput numbers
+    pipe_name = "TinyI2V" if is_i2v else "TinyT2V"
+    checkpoint_folder = rp.path_join(benchmark_folder, "checkpoints", pipe_name)
+    if not rp.folder_exists(checkpoint_folder):
+        make_tiny_checkpoint(checkpoint_folder, is_i2v=is_i2v)
+    inference.pipe_ids[pipe_name] = checkpoint_folder
+    sample_paths = make_synthetic_samples(rp.path_join(benchmark_folder, "samples"), num_samples)
+
+    jobs_kwargs = [
+        dict(
+            sample_path=sample_path,
+            degradation=degradation,
+            prompt="a synthetic benchmark video",
+            num_inference_steps=num_inference_steps,
+            step_reuse=step_reuse,
+        )
+        for sample_path, degradation in itertools.product(sample_paths, degradations)
+    ]
+
+    if workers:
+        devices = [str(x) for x in workers] if isinstance(workers, (list, tuple)) else [device] * workers
+        stage_seconds, stages, total_seconds, startup_seconds = run_workers(pipe_name, checkpoint_folder, jobs_kwargs, devices, memory_profile, previews, run_folder)
+    else:
+        devices = [device]
+        stage_seconds, stages, total_seconds, startup_seconds = run_serial(pipe_name, jobs_kwargs, device, memory_profile, previews, run_folder)
+
+    num_jobs = len(jobs_kwargs)
+    results = dict(
+        num_jobs=num_jobs,
+        num_inference_steps=num_inference_steps,
+        step_reuse=step_reuse,
+        previews=previews,
+        memory_profile=memory_profile,
+        devices=devices,
+        startup_seconds=startup_seconds,
+        total_seconds=total_seconds,
+        jobs_per_hour=3600 * num_jobs / total_seconds,
+        jobs_per_hour_with_startup=3600 * num_jobs / (total_seconds + (startup_seconds or 0)),
+        stage_seconds=dict(stage_seconds),
+    )
+    with open(rp.path_join(run_folder, "benchmark_results.json"), "w") as file:
+        json.dump(results, file, indent=4)
+
+    busy_seconds = sum(stage_seconds[stage] for stage in stages)
+    print()
+    print(f"{'stage':16}  {'seconds':>9}  {'per job':>9}  {'share':>6}")
+    for stage in stages:
+        seconds = stage_seconds[stage]
+        print(f"{stage:16}  {seconds:9.2f}  {seconds / num_jobs:9.2f}  {seconds / busy_seconds:6.1%}")
+    print()
+    if startup_seconds is None:
+        print(f"Wall clock with {len(devices)} workers, including their startup: {total_seconds:.2f}s")
+        print(f"Jobs/hour: {results['jobs_per_hour']:.1f}")
+    else:
+        print(f"get_pipe startup: {startup_seconds:.2f}s")
+        print(f"Jobs/hour: {results['jobs_per_hour']:.1f} ({results['jobs_per_hour_with_startup']:.1f} counting startup)")
+    print(f"Results: {rp.path_join(run_folder, 'benchmark_results.json')}")
+    return results
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
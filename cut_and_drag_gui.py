@@ -1,53 +1,84 @@
 from rp import *
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.widgets import Slider
-from matplotlib.patches import Polygon as Polygon
 import cv2
-git_import('CommonSource')
-import rp.git.CommonSource.noise_warp as nw
 from easydict import EasyDict
+import hashlib
+import subprocess
+import threading
+
+
+def _make_blit_redraw(fig, ax, artists, extra_axes=()):
+    """
+    Returns a redraw() function that only repaints the given artists, on top of a cached copy of everything else in ax
+    The cache is refreshed whenever the figure does a full draw (like when the window is resized)
+    extra_axes are small axes (like sliders) that get redrawn whole and blitted along with ax
+    This way clicks and slider drags never redraw the (possibly huge) image
+    """
+    canvas = fig.canvas
+    cache = EasyDict(background=None)
+
+    for artist in artists:
+        artist.set_animated(True)  # Keeps them out of the cached background
+
+    def draw_artists():
+        for artist in artists:
+            ax.draw_artist(artist)
+
+    def on_draw(event):
+        cache.background = canvas.copy_from_bbox(ax.bbox)
+        draw_artists()
+
+    canvas.mpl_connect("draw_event", on_draw)
+
+    def redraw():
+        if cache.background is None:
+            canvas.draw_idle()  # Nothing cached yet - the first full draw will take care of it
+            return
+        canvas.restore_region(cache.background)
+        draw_artists()
+        canvas.blit(ax.bbox)
+        for extra_ax in extra_axes:
+            fig.draw_artist(extra_ax)
+            canvas.blit(extra_ax.bbox)
+
+    return redraw
 
 
 def select_polygon(image):
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Polygon
+
     fig, ax = plt.subplots()
     ax.imshow(image)
     ax.set_title("Left click to add points. Right click to undo. Close the window to finish.")
 
     path = []
 
+    (edges,) = ax.plot([], [], "ro-")
+    (closing_edge,) = ax.plot([], [], "r--")
+    polygon = Polygon(np.zeros((1, 2)), closed=True, alpha=0.3, facecolor="r", edgecolor="r", visible=False)
+    ax.add_patch(polygon)
+    redraw = _make_blit_redraw(fig, ax, [polygon, edges, closing_edge])
+
     def onclick(event):
         if event.button == 1:  # Left click
             if event.xdata is not None and event.ydata is not None:
                 path.append((event.xdata, event.ydata))
-            ax.clear()
-            ax.imshow(image)
-            ax.set_title("Left click to add points. Right click to undo. Close the window to finish.")
-            for i in range(len(path)):
-                if i > 0:
-                    ax.plot([path[i - 1][0], path[i][0]], [path[i - 1][1], path[i][1]], "r-")
-                ax.plot(path[i][0], path[i][1], "ro")
-            if len(path) > 1:
-                ax.plot([path[-1][0], path[0][0]], [path[-1][1], path[0][1]], "r--")
-            if len(path) > 2:
-                polygon = Polygon(path, closed=True, alpha=0.3, facecolor="r", edgecolor="r")
-                ax.add_patch(polygon)
-            fig.canvas.draw()
         elif event.button == 3 and path:  # Right click
             path.pop()
-            ax.clear()
-            ax.imshow(image)
-            ax.set_title("Left click to add points. Right click to undo. Close the window to finish.")
-            for i in range(len(path)):
-                if i > 0:
-                    ax.plot([path[i - 1][0], path[i][0]], [path[i - 1][1], path[i][1]], "r-")
-                ax.plot(path[i][0], path[i][1], "ro")
-            if len(path) > 1:
-                ax.plot([path[-1][0], path[0][0]], [path[-1][1], path[0][1]], "r--")
-            if len(path) > 2:
-                polygon = Polygon(path, closed=True, alpha=0.3, facecolor="r", edgecolor="r")
-                ax.add_patch(polygon)
-            fig.canvas.draw()
+        else:
+            return
+
+        points = np.array(path).reshape(-1, 2)
+        edges.set_data(points[:, 0], points[:, 1])
+        if len(path) > 1:
+            closing_edge.set_data(points[[-1, 0], 0], points[[-1, 0], 1])
+        else:
+            closing_edge.set_data([], [])
+        polygon.set_visible(len(path) > 2)
+        if len(path) > 2:
+            polygon.set_xy(points)
+        redraw()
 
     cid = fig.canvas.mpl_connect("button_press_event", onclick)
     plt.show()
@@ -57,6 +88,8 @@ def select_polygon(image):
 
 
 def select_polygon_and_path(image):
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.imshow(image)
     ax.set_title("Left click to add points. Right click to undo. Close the window to finish.")
@@ -71,7 +104,18 @@ def select_polygon_and_path(image):
     return polygon_path, movement_path
 
 
-def select_path(image, polygon, num_frames=49):
+def select_path(image, polygon, num_frames=49, other_layers=None, preview_height=120, preview_fps=12):
+    """
+    Lets the user click a motion path for the polygon, with sliders for its final scale and rotation
+    A small preview pane on the left plays the resulting animation at a proxy resolution (preview_height pixels tall),
+    on top of other_layers (a THWC RGBA video of the layers authored so far, like new_layer_stack's video) if given
+    Returns (path, scales, rotations) with num_frames entries each, ready for animate_polygon
+    """
+    #matplotlib is only imported by the interactive parts, so importing this file's helpers stays fast
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider
+    from matplotlib.collections import PolyCollection
+
     fig, ax = plt.subplots()
     plt.subplots_adjust(left=0.25, bottom=0.25)
     ax.imshow(image)
@@ -85,6 +129,7 @@ def select_path(image, polygon, num_frames=49):
 
     scale_slider = Slider(ax_scale, "Final Scale", 0.1, 5.0, valinit=1)
     rot_slider = Slider(ax_rot, "Final Rotation", -360, 360, valinit=0)
+    scale_slider.drawon = rot_slider.drawon = False  # We blit them ourselves instead of redrawing the whole figure
 
     scales = []
     rotations = []
@@ -95,40 +140,28 @@ def select_path(image, polygon, num_frames=49):
         rotations = np.linspace(0, rot_slider.val, n_points)
         return scales, rotations
 
+    (path_line,) = ax.plot([], [], "bo-")
+    polygons = PolyCollection([], closed=True, alpha=0.3, facecolor="r", edgecolor="r")
+    ax.add_collection(polygons)
+    redraw = _make_blit_redraw(fig, ax, [polygons, path_line], extra_axes=[ax_scale, ax_rot])
+
+    preview = _make_path_preview(fig, image, polygon, num_frames, other_layers, preview_height, preview_fps)
+
     def update_display():
-        ax.clear()
-        ax.imshow(image)
-        ax.set_title("Left click to add points. Right click to undo. Close the window to finish.")
+        preview.set_animation(path, scale_slider.val, rot_slider.val)
 
         n_points = len(path)
+        points = np.array(path).reshape(-1, 2)
+        path_line.set_data(points[:, 0], points[:, 1])
+
         if n_points < 1:
-            fig.canvas.draw_idle()
-            return
+            polygons.set_verts([])
+        else:
+            # Interpolate scales and rotations over the total number of points
+            scales[:], rotations[:] = interpolate_transformations(n_points)
+            polygons.set_verts(list(get_path_polygons(polygon, points, scales, rotations)))
 
-        # Interpolate scales and rotations over the total number of points
-        scales[:], rotations[:] = interpolate_transformations(n_points)
-
-        origin = np.array(path[0])
-
-        for i in range(n_points):
-            ax.plot(path[i][0], path[i][1], "bo")
-            if i > 0:
-                ax.plot([path[i - 1][0], path[i][0]], [path[i - 1][1], path[i][1]], "b-")
-            # Apply transformation to the polygon
-            transformed_polygon = apply_transformation(np.array(polygon), scales[i], rotations[i], origin)
-            # Offset polygon to the current point relative to the first point
-            position_offset = np.array(path[i]) - origin
-            transformed_polygon += position_offset
-            mpl_poly = Polygon(
-                transformed_polygon,
-                closed=True,
-                alpha=0.3,
-                facecolor="r",
-                edgecolor="r",
-            )
-            ax.add_patch(mpl_poly)
-
-        fig.canvas.draw_idle()
+        redraw()
 
     def onclick(event):
         if event.inaxes != ax:
@@ -151,40 +184,118 @@ def select_path(image, polygon, num_frames=49):
     cid_click = fig.canvas.mpl_connect("button_press_event", onclick)
     plt.show()
     fig.canvas.mpl_disconnect(cid_click)
+    preview.stop()
 
     # Final interpolation after the window is closed
-    n_points = num_frames
-    if n_points > 0:
-        scales, rotations = interpolate_transformations(n_points)
-        rotations = [-x for x in rotations]
-        path = as_numpy_array(path)
-        path = as_numpy_array([linterp(path, i) for i in np.linspace(0, len(path) - 1, num=n_points)])
+    return interpolate_animation(path, scale_slider.val, rot_slider.val, num_frames)
 
+
+def interpolate_animation(path, final_scale, final_rotation, num_frames=49):
+    # Turns the clicked path and slider values into per-frame (path, scales, rotations) for animate_polygon
+    scales = np.exp(np.linspace(0, np.log(final_scale), num_frames))
+    rotations = -np.linspace(0, final_rotation, num_frames)
+    path = as_numpy_array(path)
+    path = as_numpy_array([linterp(path, i) for i in np.linspace(0, len(path) - 1, num=num_frames)])
     return path, scales, rotations
 
 
-def animate_polygon(image, polygon, path, scales, rotations,interp=cv2.INTER_LINEAR):
+def _make_path_preview(fig, image, polygon, num_frames, other_layers, preview_height, preview_fps):
+    """
+    The looping animated preview pane of select_path
+    Everything is done at a proxy resolution: the image and other layers are downscaled once, up front.
+    set_animation only marks the preview as stale - it's re-rendered at most once per timer tick,
+    so dragging a slider doesn't render an animation for every intermediate value.
+    """
+    factor = min(1, preview_height / image.shape[0])
+    size = (round(image.shape[1] * factor), round(image.shape[0] * factor))  # (w, h) for cv2
+
+    proxy_image = as_byte_image(as_rgb_image(image))
+    proxy_image = cv2.resize(proxy_image, size, interpolation=cv2.INTER_AREA)
+    proxy_background = np.repeat(as_rgba_image(proxy_image)[None], num_frames, axis=0)
+    if other_layers is not None:
+        other_layers = [cv2.resize(as_byte_image(x), size, interpolation=cv2.INTER_AREA) for x in other_layers]
+        proxy_background = np.stack([_alpha_over(below, above) for below, above in zip(proxy_background, other_layers)])
+    proxy_polygon = np.asarray(polygon) * factor
+
+    preview_ax = fig.add_axes([0.01, 0.35, 0.18, 0.4])
+    preview_ax.set_title("Preview", fontsize=8)
+    preview_ax.set_axis_off()
+    preview_artist = preview_ax.imshow(proxy_background[0])
+    redraw = _make_blit_redraw(fig, preview_ax, [preview_artist])
+
+    state = EasyDict(frames=proxy_background, frame_number=0, animation=None, stale=False)
+
+    def set_animation(path, final_scale, final_rotation):
+        state.animation = (list(path), final_scale, final_rotation)
+        state.stale = True
+
+    def render():
+        path, final_scale, final_rotation = state.animation
+        if not path:
+            state.frames = proxy_background
+            return
+        proxy_path, scales, rotations = interpolate_animation(np.asarray(path) * factor, final_scale, final_rotation, num_frames)
+        layer = animate_polygon(proxy_image, proxy_polygon, proxy_path, scales, rotations, show_progress=False).frames
+        state.frames = [_alpha_over(below, above) for below, above in zip(proxy_background, layer)]
+
+    def tick():
+        if state.stale:
+            state.stale = False
+            render()
+        state.frame_number = (state.frame_number + 1) % len(state.frames)
+        preview_artist.set_data(state.frames[state.frame_number])
+        redraw()
+
+    timer = fig.canvas.new_timer(interval=1000 / preview_fps)
+    timer.add_callback(tick)
+    timer.start()
+
+    return EasyDict(set_animation=set_animation, stop=timer.stop, tick=tick)
+
+
+def get_path_polygons(polygon, path, scales, rotations):
+    """
+    Vectorized apply_transformation for every point along a path at once, moved to each point like select_path shows them
+    Returns an array of shape (len(path), len(polygon), 2)
+    """
+    path = np.asarray(path, dtype=float)
+    origin = path[0]
+    theta = np.deg2rad(np.asarray(rotations, dtype=float))
+    rotation_matrices = np.stack([np.stack([np.cos(theta), -np.sin(theta)], -1), np.stack([np.sin(theta), np.cos(theta)], -1)], -2)
+    rotated = np.einsum("pj,njk->npk", np.asarray(polygon, dtype=float) - origin, rotation_matrices)
+    return rotated * np.asarray(scales, dtype=float)[:, None, None] + path[:, None, :]
+
+
+def get_affine_matrix(origin, position, scale, rotation):
+    # The 2x3 matrix that scales and rotates around origin, then moves origin to position
+    theta = np.deg2rad(rotation)
+
+    a11 = scale * np.cos(theta)
+    a12 = -scale * np.sin(theta)
+    a21 = scale * np.sin(theta)
+    a22 = scale * np.cos(theta)
+
+    # Compute translation components
+    tx = position[0] - (a11 * origin[0] + a12 * origin[1])
+    ty = position[1] - (a21 * origin[0] + a22 * origin[1])
+
+    return np.array([[a11, a12, tx], [a21, a22, ty]])
+
+
+def animate_polygon(image, polygon, path, scales, rotations,interp=cv2.INTER_LINEAR,show_progress=True):
     frames = []
     transformed_polygons = []
     origin = np.array(path[0])
 
     h, w = image.shape[:2]
 
-    for i in eta(range(len(path)), title="Creating frames for this layer..."):
-        # Compute the affine transformation matrix
-        theta = np.deg2rad(rotations[i])
-        scale = scales[i]
-
-        a11 = scale * np.cos(theta)
-        a12 = -scale * np.sin(theta)
-        a21 = scale * np.sin(theta)
-        a22 = scale * np.cos(theta)
+    frame_numbers = range(len(path))
+    if show_progress:
+        frame_numbers = eta(frame_numbers, title="Creating frames for this layer...")
 
-        # Compute translation components
-        tx = path[i][0] - (a11 * origin[0] + a12 * origin[1])
-        ty = path[i][1] - (a21 * origin[0] + a22 * origin[1])
-
-        M = np.array([[a11, a12, tx], [a21, a22, ty]])
+    for i in frame_numbers:
+        # Compute the affine transformation matrix
+        M = get_affine_matrix(origin, path[i], scales[i], rotations[i])
 
         # Apply the affine transformation to the image
         warped_image = cv2.warpAffine(
@@ -236,6 +347,335 @@ def apply_transformation(polygon, scale, rotation, origin):
     return final_polygon
 
 
+def warp_layer_noise(image, polygon, animation):
+    # The full resolution noise path: warps (HEIGHT, WIDTH, 16) noise along the layer's animation, in 3-channel chunks. THWC
+    height, width = image.shape[:2]
+    layer_noise = np.random.randn(height, width, 18).astype(np.float32)
+    noise_outputs = [
+        as_numpy_array(animate_polygon(layer_noise[:, :, 3 * i : 3 * (i + 1)], polygon, *animation, interp=cv2.INTER_NEAREST).frames)
+        for i in range(6)
+    ]
+    return np.concatenate(
+        [x[:, :, :, :3] for x in noise_outputs[:5]] + [noise_outputs[5][:, :, :, :1]],
+        axis=3,#THWC
+    )
+
+
+def _get_rescale_matrix(factor):
+    # Maps pixel coordinates to the coordinates of an image downscaled by factor (pixel centers stay aligned)
+    offset = 0.5 / factor - 0.5
+    return np.array([[1 / factor, 0, offset], [0, 1 / factor, offset], [0, 0, 1]])
+
+
+def get_polygon_coverage(polygon, height, width, supersample=16):
+    """
+    Rasterizes a polygon onto a (height, width) grid as fractional coverage between 0 and 1
+    Cell (y, x) spans [x-.5, x+.5] x [y-.5, y+.5]. Each cell is cut into supersample rows, and the polygon's exact span along each row is measured
+    (even-odd rule), so a cell's coverage is the fraction of its area inside the polygon, to within 1/supersample along horizontal-ish edges
+    """
+    polygon = np.asarray(polygon, dtype=np.float64)
+    (x0, y0), (x1, y1) = polygon.T, np.roll(polygon, -1, axis=0).T
+    H = height * supersample
+
+    # Where every edge crosses every sample row
+    sample_y = (np.arange(H)[:, None] + 0.5) / supersample - 0.5
+    crosses = (y0 <= sample_y) != (y1 <= sample_y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossing_x = x0 + (sample_y - y0) / (y1 - y0) * (x1 - x0)
+    crossing_x = np.sort(np.where(crosses, crossing_x, np.inf), axis=1)
+
+    # Inside spans run between consecutive pairs of crossings. A span boundary at x covers (or uncovers) everything to its right:
+    # the part of its own cell right of x, and all of every later cell. Clipping to the grid is done by clamping the boundaries
+    crossing_x = np.clip(crossing_x, -0.5, width - 0.5)
+    cell = np.minimum(np.floor(crossing_x + 0.5), width - 1).astype(int)
+    signs = np.broadcast_to(np.where(np.arange(crossing_x.shape[1]) % 2, -1.0, 1.0), crossing_x.shape)  # Unused (inf) crossings cancel out
+    offsets = np.arange(H)[:, None] * (width + 1)
+    partial = np.bincount((offsets + cell).ravel(), (signs * (cell + 0.5 - crossing_x)).ravel(), H * (width + 1))
+    whole = np.bincount((offsets + cell + 1).ravel(), signs.ravel(), H * (width + 1))
+    rows = (partial + np.cumsum(whole.reshape(H, width + 1), axis=1).ravel()).reshape(H, width + 1)[:, :width]
+
+    return rows.reshape(height, supersample, width).mean(1).astype(np.float32)
+
+
+def get_polygon_area(polygon):
+    # Shoelace formula. Only meaningful for polygons that don't cross themselves
+    x, y = np.asarray(polygon, dtype=np.float64).T
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def check_polygon_coverage(supersample=16):
+    # Sanity check for get_polygon_coverage: on polygons inside the grid, total coverage must be the polygon's area
+    polygons = [
+        [[9.5, 9.5], [19.5, 9.5], [19.5, 19.5], [9.5, 19.5]],  # Exactly 10x10 cells
+        [[9.5, 9.5], [11, 9.5], [11, 11], [9.5, 11]],  # 1.5x1.5, smaller than two cells
+        [[4.8, 6.6], [39.7, 12.2], [30.4, 49.9], [8.3, 32.8], [20, 25]],  # Concave, off-grid
+    ]
+    for polygon in polygons:
+        coverage = get_polygon_coverage(polygon, 60, 90, supersample)
+        perimeter = np.linalg.norm(np.diff(polygon + polygon[:1], axis=0), axis=1).sum()
+        assert abs(coverage.sum() - get_polygon_area(polygon)) <= perimeter / supersample, (polygon, coverage.sum(), get_polygon_area(polygon))
+        assert coverage.min() >= 0 and coverage.max() <= 1
+
+
+def warp_layer_noise_latent(polygon, path, scales, rotations, height, width, downscale_factor=8, supersample=1, channels=16):
+    """
+    Makes a layer's warped noise directly at latent resolution, instead of warping full-resolution noise and downsampling it at the end
+    height and width are the full-resolution image size, and the outputs are (height, width) / downscale_factor * supersample
+
+    Returns (noises, coverages):
+        noises    (T, h, w, channels): The layer's own gaussian noise, nearest-neighbor warped along its animation
+        coverages (T, h, w)          : How much of each cell the layer's transformed polygon covers, from 0 to 1
+
+    Layers are composited with composite_latent_noises. With supersample > 1, the noise is warped at a finer grid
+    and later summed back down (see downsample_noises), which keeps motion smoother than whole-latent steps.
+    """
+    factor = downscale_factor / supersample
+    h, w = round(height / factor), round(width / factor)
+    S = _get_rescale_matrix(factor)
+
+    noise = np.random.randn(h, w, channels).astype(np.float32)
+    origin = np.array(path[0])
+    polygon = np.asarray(polygon, dtype=np.float64)
+
+    # Nearest-neighbor inverse warp of every frame at once: output cell -> source cell
+    matrices = [get_affine_matrix(origin, path[i], scales[i], rotations[i]) for i in range(len(path))]
+    matrices = np.stack([S @ np.vstack([M, [0, 0, 1]]) @ np.linalg.inv(S) for M in matrices])  # T 3 3
+    grid = np.stack([*np.meshgrid(np.arange(w), np.arange(h)), np.ones((h, w))], axis=-1)  # h w 3
+    source = np.einsum("tij,hwj->thwi", np.linalg.inv(matrices), grid)
+    source_x = np.clip(np.round(source[..., 0]).astype(int), 0, w - 1)
+    source_y = np.clip(np.round(source[..., 1]).astype(int), 0, h - 1)
+    noises = noise[source_y, source_x]
+
+    polygon_ones = np.hstack([polygon, np.ones((len(polygon), 1))])
+    coverages = np.stack([get_polygon_coverage((polygon_ones @ (M @ S).T)[:, :2], h, w) for M in matrices])
+
+    return noises, coverages
+
+
+def composite_latent_noises(background_noise, layer_noises, layer_coverages):
+    """
+    Stacks layers back to front over the background noise, like overlay_images does with the video frames
+    Where a layer covers a fraction c of a cell, the cell becomes sqrt(1-c)*below + sqrt(c)*layer.
+    Since the layers' noises are independent, that keeps every cell unit variance - a partially covered latent
+    gets the same statistics as averaging the covered and uncovered pixels' noise at full resolution.
+    """
+    output = background_noise
+    for noise, coverage in zip(layer_noises, layer_coverages):
+        coverage = coverage[..., None]
+        output = np.sqrt(1 - coverage) * output + np.sqrt(coverage) * noise
+    return output
+
+
+def downsample_noises(noises, factor):
+    # Sums factor x factor blocks and divides by factor, so unit variance gaussian noise stays unit variance. THWC
+    if factor == 1:
+        return noises
+    T, h, w, C = noises.shape
+    return noises.reshape(T, h // factor, factor, w // factor, factor, C).sum((2, 4)) / factor
+
+
+def _alpha_over(bottom, top):
+    # Straight-alpha "over" compositing of two uint8 RGBA images, like overlay_images(bottom, top)
+    top_alpha = top[..., 3:] / 255
+    bottom_alpha = bottom[..., 3:] / 255 * (1 - top_alpha)
+    alpha = top_alpha + bottom_alpha
+    rgb = (top[..., :3] * top_alpha + bottom[..., :3] * bottom_alpha) / np.maximum(alpha, 1e-8)
+    return np.concatenate([rgb, alpha * 255], axis=-1).round().astype(np.uint8)
+
+
+def new_layer_stack(num_frames, height, width):
+    """
+    Running accumulators for the cut-and-drag layers, so each layer can be folded in and freed as soon as it's made
+    Layers must be added back to front (the same order overlay_images stacks them), which is the order they're authored in
+    Peak memory is the same no matter how many layers there are
+    """
+    return EasyDict(
+        video=np.zeros((num_frames, height, width, 4), np.uint8),  # All layers so far composited over transparency. THWC RGBA
+        mask=np.zeros((num_frames, height, width), np.uint8),  # Union of the layers' alphas
+        first_frame_mask=np.zeros((height, width), bool),  # Union of the layers' first-frame masks, for inpainting
+        noise=None,  # Composited noise, starting from a static background noise when the first layer comes in. THWC
+        polygons=[],
+    )
+
+
+def add_layer_to_stack(stack, frames, transformed_polygons, noises, coverages=None):
+    """
+    Folds one layer into the stack, on top of the layers already in it
+    noises is the layer's warped noise (THWC). coverages (THW, 0 to 1) says where it goes - if None, it goes wherever the frames' alpha > 0
+    """
+    num_frames = len(stack.video)
+    if coverages is None:
+        coverages = as_numpy_array([get_image_alpha(x) > 0 for x in frames])
+
+    if stack.noise is None:
+        background_noise = np.random.randn(1, *noises.shape[1:]).astype(np.float32)
+        stack.noise = np.repeat(background_noise, num_frames, axis=0)
+
+    for i in range(num_frames):
+        frame = as_byte_image(as_rgba_image(frames[i]))
+        stack.video[i] = _alpha_over(stack.video[i], frame)
+        stack.mask[i] = np.maximum(stack.mask[i], frame[:, :, 3])
+        stack.noise[i] = composite_latent_noises(stack.noise[i], [noises[i]], [coverages[i]])
+
+    stack.first_frame_mask |= get_image_alpha(frames[0]) > 0
+    stack.polygons.append(transformed_polygons)
+
+
+_inpaint_cache = {}
+
+
+def inpaint_background(image, mask, proxy_scale=0.25, padding=32, radius=3, cache_folder=None):
+    """
+    A faster cv_inpaint_image for filling in the holes left by the cut-out layers, with the same "mask==True gets inpainted" convention
+        - Only a bounding box around the mask (plus padding pixels) is processed - the rest of the image is left alone
+        - The inside of the holes is inpainted on a proxy downscaled by proxy_scale, then upsampled
+        - Only a thin band along the hole's edges is inpainted at full resolution, using the upsampled fill as a guide,
+          so the seams match the surrounding pixels
+    Results are cached by a hash of the image, mask and settings - in memory, and in cache_folder (as .npy files) if it's given
+    Returns an RGB uint8 image
+    """
+    image = as_byte_image(as_rgb_image(image))
+    mask = as_numpy_array(mask).astype(bool)
+
+    key = hashlib.sha256(b"".join([image.tobytes(), np.packbits(mask).tobytes(), repr((image.shape, proxy_scale, padding, radius)).encode()])).hexdigest()
+    cache_path = path_join(cache_folder, key + ".npy") if cache_folder else None
+    if key in _inpaint_cache:
+        return _inpaint_cache[key].copy()
+    if cache_path and file_exists(cache_path):
+        _inpaint_cache[key] = np.load(cache_path)
+        return _inpaint_cache[key].copy()
+
+    output = image.copy()
+    if mask.any():
+        ys, xs = np.nonzero(mask)
+        y0, y1 = max(ys.min() - padding, 0), min(ys.max() + padding + 1, mask.shape[0])
+        x0, x1 = max(xs.min() - padding, 0), min(xs.max() + padding + 1, mask.shape[1])
+        crop, crop_mask = image[y0:y1, x0:x1], mask[y0:y1, x0:x1]
+        h, w = crop_mask.shape
+
+        # Inpaint the inside of the holes on a downscaled proxy
+        proxy_size = (max(round(w * proxy_scale), 1), max(round(h * proxy_scale), 1))
+        proxy = cv2.resize(crop, proxy_size, interpolation=cv2.INTER_AREA)
+        proxy_mask = cv2.resize(crop_mask.astype(np.uint8), proxy_size, interpolation=cv2.INTER_AREA) > 0  # Any coverage counts as a hole
+        proxy = cv_inpaint_image(proxy, mask=proxy_mask, radius=radius)
+        guide = cv2.resize(as_byte_image(as_rgb_image(proxy)), (w, h), interpolation=cv2.INTER_LINEAR)
+
+        # Inpaint the band along the edges of the holes at full resolution, with the upsampled fill as known pixels inside
+        band_width = max(round(1 / proxy_scale), 1) * 2 + 1
+        outside = ~crop_mask
+        near_outside = cv2.dilate(outside.astype(np.uint8), np.ones((band_width, band_width), np.uint8)) > 0
+        band = crop_mask & near_outside
+        guided_crop = np.where(crop_mask[:, :, None], guide, crop)
+        guided_crop = as_byte_image(as_rgb_image(cv_inpaint_image(guided_crop, mask=band, radius=radius)))
+
+        output[y0:y1, x0:x1] = np.where(crop_mask[:, :, None], guided_crop, crop)
+
+    _inpaint_cache[key] = output
+    if cache_path:
+        make_directory(cache_folder)
+        np.save(cache_path, output)
+    return output.copy()
+
+
+# How save_template_outputs stores the video and mask. 'h264' uses the same settings as save_video_mp4(video_bitrate="max"),
+# which is rp's 10^10 bits/second target bitrate with libx264's default preset - not a CRF
+video_formats = dict(
+    h264     = dict(extension=".mp4", codec_args=["-c:v", "libx264", "-b:v", "10000000000", "-pix_fmt", "yuv420p"]),
+    lossless = dict(extension=".mp4", codec_args=["-c:v", "libx264rgb", "-preset", "fast", "-qp", "0"]),
+    uint8    = dict(extension=".npy", codec_args=None),  # No encoding at all - the raw frames, in a numpy archive
+)
+
+
+def get_ffmpeg_path():
+    try:
+        import imageio_ffmpeg  # Comes with a static ffmpeg, so it works even without a system install
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return "ffmpeg"
+
+
+def open_video_writer(path, num_frames, height, width, channels, framerate, video_format="h264"):
+    """
+    Returns a (write(frame), close()) pair that saves uint8 HWC frames one at a time, with channels=3 for RGB or 1 for grayscale
+    Encoded formats stream raw frames to an ffmpeg subprocess over stdin, so several writers can encode at once without temp files
+    """
+    settings = video_formats[video_format]
+
+    if settings["codec_args"] is None:
+        shape = (num_frames, height, width) if channels == 1 else (num_frames, height, width, channels)
+        archive = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+        index = [0]
+
+        def write(frame):
+            archive[index[0]] = frame.reshape(archive.shape[1:])
+            index[0] += 1
+
+        def close():
+            archive.flush()
+
+        return write, close
+
+    process = subprocess.Popen(
+        [
+            get_ffmpeg_path(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "gray" if channels == 1 else "rgb24", "-s", f"{width}x{height}", "-r", str(framerate), "-i", "-",
+            *settings["codec_args"],
+            path,
+        ],
+        stdin=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    def write(frame):
+        process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+
+    def close():
+        process.stdin.close()
+        error = process.stderr.read().decode()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to save {path}: {error}")
+
+    return write, close
+
+
+def save_template_outputs(frames, masks, path_prefix, cartridge=None, framerate=60, video_format="h264"):
+    """
+    Saves the composited video and the mask video in a single pass over the frames, while the cartridge is written on another thread
+    Each frame is sent to both encoders as soon as it's ready, and the two ffmpeg processes encode concurrently
+    frames are RGB or RGBA images, masks are grayscale images. Returns the video, mask and cartridge paths (the cartridge's is None if not given)
+    """
+    extension = video_formats[video_format]["extension"]
+    video_path = path_prefix + extension
+    mask_path = path_prefix + "_mask" + extension
+    cartridge_path = path_prefix + "_cartridge.pkl" if cartridge is not None else None
+
+    cartridge_thread = None
+    if cartridge is not None:
+        cartridge_thread = threading.Thread(target=object_to_file, args=(cartridge, cartridge_path))
+        cartridge_thread.start()
+
+    height, width = get_image_dimensions(frames[0])
+    write_video, close_video = open_video_writer(video_path, len(frames), height, width, 3, framerate, video_format)
+    write_mask, close_mask = open_video_writer(mask_path, len(masks), height, width, 1, framerate, video_format)
+    try:
+        for frame, mask in zip(eta(frames, title="Saving video and mask"), masks):
+            write_video(as_byte_image(as_rgb_image(frame)))
+            write_mask(as_byte_image(as_grayscale_image(mask)))
+    finally:
+        # Each one is closed even if closing another fails, so no ffmpeg process or half-written pickle is left behind
+        try:
+            close_video()
+        finally:
+            try:
+                close_mask()
+            finally:
+                if cartridge_thread is not None:
+                    cartridge_thread.join()
+
+    return video_path, mask_path, cartridge_path
+
+
 # def cogvlm_caption_video(video_path, prompt="Please describe this video in detail."):
 #     import rp.web_evaluator as wev
 #
@@ -247,12 +687,24 @@ def apply_transformation(polygon, scale, rotation, origin):
 
 
 if __name__ == "__main__":
+    git_import('CommonSource')
+    import rp.git.CommonSource.noise_warp as nw
+
+    check_polygon_coverage() #Takes milliseconds, and LATENT_NOISE's layer masks depend on it
+
     fansi_print(big_ascii_text("Go With The Flow!"), "yellow green", "bold")
 
-    image_path = input_conditional(
-        fansi("First Frame: Enter Image Path or URL", "blue cyan", "italic bold underlined"),
-        lambda x: is_a_file(x.strip()) or is_valid_url(x.strip()),
-    ).strip()
+    #Usage: python cut_and_drag_gui.py [image_path [output_root]]
+    #Anything not given on the command line is asked for interactively. gradio_app.py passes both.
+    import sys
+    if len(sys.argv) > 1:
+        image_path = sys.argv[1]
+    else:
+        image_path = input_conditional(
+            fansi("First Frame: Enter Image Path or URL", "blue cyan", "italic bold underlined"),
+            lambda x: is_a_file(x.strip()) or is_valid_url(x.strip()),
+        ).strip()
+    output_root = sys.argv[2] if len(sys.argv) > 2 else "."
 
     print("Using path: " + fansi_highlight_path(image_path))
     if is_video_file(image_path):
@@ -266,6 +718,10 @@ if __name__ == "__main__":
     prompt=input(fansi('Input the video caption >>> ','blue cyan','bold'))
 
     SCALE_FACTOR=1
+    LATENT_NOISE=True #Warp the noise at latent resolution (1/8 the size) instead of full resolution. Uses ~64x less memory and time.
+    NOISE_SUPERSAMPLE=2 #With LATENT_NOISE, warp at this multiple of latent resolution to keep the motion smoother
+    INPAINT_CACHE_FOLDER=path_join(output_root,'inpaint_cache') #Inpainted backgrounds are reused from here when the image and layer masks haven't changed
+    VIDEO_FORMAT='h264' #How to save the video and mask. See video_formats - 'lossless' and 'uint8' skip the lossy encode
     #Adjust resolution to 720x480: resize then center-crop
     HEIGHT=480*SCALE_FACTOR
     WIDTH=720*SCALE_FACTOR
@@ -278,7 +734,7 @@ if __name__ == "__main__":
             include_file_extension=False,
         ),
     )
-    output_folder=make_directory(get_unique_copy_path(title))
+    output_folder=make_directory(get_unique_copy_path(path_join(output_root,title)))
     print("Output folder: " + fansi_highlight_path(output_folder))
 
     fansi_print("How many layers?", "blue cyan", "italic bold underlined"),
@@ -286,53 +742,31 @@ if __name__ == "__main__":
         minimum=1,
     )
 
-    layer_videos = []
-    layer_polygons = []
-    layer_first_frame_masks = []
-    layer_noises = []
+    layer_stack = new_layer_stack(49, HEIGHT, WIDTH)
 
     for layer_num in range(num_layers):
-        layer_noise=np.random.randn(HEIGHT,WIDTH,18).astype(np.float32)
-
         fansi_print(f'You are currently working on layer #{layer_num+1} of {num_layers}','yellow orange','bold')
         if True or not "polygon" in vars() or input_yes_no("New Polygon?"):
             polygon = select_polygon(image)
         if True or not "animation" in vars() or input_yes_no("New Animation?"):
-            animation = select_path(image, polygon)
+            animation = select_path(image, polygon, other_layers=layer_stack.video if layer_num else None)
 
         
         animation_output = animate_polygon(image, polygon, *animation)
-
-        noise_output_1 = as_numpy_array(animate_polygon(layer_noise[:,:,3*0:3*1], polygon, *animation, interp=cv2.INTER_NEAREST).frames)
-        noise_output_2 = as_numpy_array(animate_polygon(layer_noise[:,:,3*1:3*2], polygon, *animation, interp=cv2.INTER_NEAREST).frames)
-        noise_output_3 = as_numpy_array(animate_polygon(layer_noise[:,:,3*2:3*3], polygon, *animation, interp=cv2.INTER_NEAREST).frames)
-        noise_output_4 = as_numpy_array(animate_polygon(layer_noise[:,:,3*3:3*4], polygon, *animation, interp=cv2.INTER_NEAREST).frames)
-        noise_output_5 = as_numpy_array(animate_polygon(layer_noise[:,:,3*4:3*5], polygon, *animation, interp=cv2.INTER_NEAREST).frames)
-        noise_output_6 = as_numpy_array(animate_polygon(layer_noise[:,:,3*5:3*6], polygon, *animation, interp=cv2.INTER_NEAREST).frames)
-        noise_warp_output = np.concatenate(
-            [
-                noise_output_1[:,:,:,:3],
-                noise_output_2[:,:,:,:3],
-                noise_output_3[:,:,:,:3],
-                noise_output_4[:,:,:,:3],
-                noise_output_5[:,:,:,:3],
-                noise_output_6[:,:,:,:1],
-            ],
-            axis=3,#THWC
-        )
-
         frames, transformed_polygons = destructure(animation_output)
 
-        mask = get_image_alpha(frames[0]) > 0
-        
-        layer_polygons.append(transformed_polygons)
-        layer_first_frame_masks.append(mask)
-        layer_videos.append(frames)
-        layer_noises.append(noise_warp_output)
+        if LATENT_NOISE:
+            layer_noises, layer_coverages = warp_layer_noise_latent(polygon, *animation, height=HEIGHT, width=WIDTH, supersample=NOISE_SUPERSAMPLE)
+        else:
+            layer_noises, layer_coverages = warp_layer_noise(image, polygon, animation), None
+
+        fansi_print(f'Adding layer #{layer_num+1} to the composite','green','bold')
+        add_layer_to_stack(layer_stack, frames, transformed_polygons, layer_noises, layer_coverages)
+        del animation_output, frames, layer_noises, layer_coverages #Peak memory shouldn't grow with the number of layers
 
     if True or input_yes_no("Inpaint background?"):
-        total_mask = sum(layer_first_frame_masks).astype(bool)
-        background = cv_inpaint_image(image, mask=total_mask)
+        total_mask = layer_stack.first_frame_mask
+        background = inpaint_background(image, mask=total_mask, cache_folder=INPAINT_CACHE_FOLDER)
     else:
         background = "https://t3.ftcdn.net/jpg/02/76/96/64/360_F_276966430_HsEI96qrQyeO4wkcnXtGZOm0Qu4TKCgR.jpg"
         background = load_image(background, use_cache=True)
@@ -343,64 +777,54 @@ if __name__ == "__main__":
     output_frames = [
         overlay_images(
             background,
-            *frame_layers,
+            layers_frame,
         )
-        for frame_layers in eta(list_transpose(layer_videos),title=fansi("Compositing all frames of the video...",'green','bold'))
+        for layers_frame in eta(layer_stack.video,title=fansi("Compositing all frames of the video...",'green','bold'))
     ]
     output_frames=as_numpy_array(output_frames)
 
-    
-    output_video_file=save_video_mp4(output_frames, output_folder+'/'+title + ".mp4", video_bitrate="max")
-    output_mask_file = save_video_mp4(
-        [
-            sum([get_image_alpha(x) for x in layers])
-            for layers in list_transpose(layer_videos)
-        ],
-        output_folder + "/" + title + "_mask.mp4",
-        video_bitrate="max",
-    )
-    
 
     ###
-    fansi_print("Warping noise...",'yellow green','bold italic')
-    output_noises = np.random.randn(1,HEIGHT,WIDTH,16)
-    output_noises=np.repeat(output_noises,49,axis=0)
-    for layer_num in range(num_layers):
-        fansi_print(f'Warping noise for layer #{layer_num+1} of {num_layers}','green','bold')
-        for frame in eta(range(49),title='frame number'):
-            noise_mask = get_image_alpha(layer_videos[layer_num][frame])[:,:,None]>0
-            noise_video_layer = layer_noises[layer_num][frame]
-            output_noises[frame]*=(noise_mask==0)
-            output_noises[frame]+=noise_video_layer*noise_mask
-            #display_image((noise_mask * noise_video_layer)[:,:,:3])
-            display_image(output_noises[frame][:,:,:3]/5+.5)
-    
     import einops
     import torch
-    torch_noises=torch.tensor(output_noises)
-    torch_noises=einops.rearrange(torch_noises,'F H W C -> F C H W')        
-    #
-    small_torch_noises=[]
-    for i in eta(range(49),title='Regaussianizing'):
-        torch_noises[i]=nw.regaussianize(torch_noises[i])[0]
-        small_torch_noise=nw.resize_noise(torch_noises[i],(480//8,720//8))
-        small_torch_noises.append(small_torch_noise)
-        #display_image(as_numpy_image(small_torch_noise[:3])/5+.5)
-        display_image(as_numpy_image(torch_noises[i,:3])/5+.5)
-    small_torch_noises=torch.stack(small_torch_noises)#DOWNSAMPLED NOISE FOR CARTRIDGE!
+    torch_noises=torch.tensor(layer_stack.noise)
+    torch_noises=einops.rearrange(torch_noises,'F H W C -> F C H W')
+    if LATENT_NOISE:
+        for i in eta(range(len(torch_noises)),title='Regaussianizing'):
+            torch_noises[i]=nw.regaussianize(torch_noises[i])[0]
+        small_torch_noises=einops.rearrange(torch_noises,'F C H W -> F H W C').numpy()
+        small_torch_noises=downsample_noises(small_torch_noises, NOISE_SUPERSAMPLE)
+        small_torch_noises=einops.rearrange(torch.tensor(small_torch_noises),'F H W C -> F C H W')#DOWNSAMPLED NOISE FOR CARTRIDGE!
+        display_image(as_numpy_image(small_torch_noises[0,:3])/5+.5)
+    else:
+        small_torch_noises=[]
+        for i in eta(range(49),title='Regaussianizing'):
+            torch_noises[i]=nw.regaussianize(torch_noises[i])[0]
+            small_torch_noise=nw.resize_noise(torch_noises[i],(480//8,720//8))
+            small_torch_noises.append(small_torch_noise)
+            #display_image(as_numpy_image(small_torch_noise[:3])/5+.5)
+            display_image(as_numpy_image(torch_noises[i,:3])/5+.5)
+        small_torch_noises=torch.stack(small_torch_noises)#DOWNSAMPLED NOISE FOR CARTRIDGE!
 
     ###
     cartridge={}
     cartridge['instance_noise']=small_torch_noises.bfloat16()
-    cartridge['instance_video']=(as_torch_images(output_frames)*2-1).bfloat16()
+    cartridge['instance_video']=torch.from_numpy(einops.rearrange(as_byte_images(as_rgb_images(output_frames)),'F H W C -> F C H W').copy()) #uint8, converted to [-1, 1] only when loaded
     cartridge['instance_prompt']=prompt
-    output_cartridge_file=object_to_file(cartridge, output_folder + "/" + title + "_cartridge.pkl")
+
+    output_video_file, output_mask_file, output_cartridge_file = save_template_outputs(
+        output_frames,
+        layer_stack.mask,
+        output_folder + "/" + title,
+        cartridge=cartridge,
+        video_format=VIDEO_FORMAT,
+    )
             
     ###
     
     
     output_polygons_file=output_folder+'/'+'polygons.npy'
-    polygons=as_numpy_array(layer_polygons)
+    polygons=as_numpy_array(layer_stack.polygons)
     np.save(output_polygons_file,polygons)
     
     print()
@@ -1,17 +1,41 @@
 import rp
 # from rp import *
-import torch
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import importlib
+import contextlib
+from collections import OrderedDict
 import numpy as np
-import einops
-from diffusers import CogVideoXImageToVideoPipeline
-from diffusers import CogVideoXVideoToVideoPipeline
-from diffusers import CogVideoXPipeline
-from diffusers.utils import export_to_video, load_image
-from icecream import ic
-from diffusers import AutoencoderKLCogVideoX, CogVideoXImageToVideoPipeline, CogVideoXTransformer3DModel 
-from transformers import T5EncoderModel
 
-import rp.git.CommonSource.noise_warp as nw
+class _LazyModule:
+    """
+    Stands in for a module that only gets imported the first time one of its attributes is used
+    torch, diffusers and transformers take seconds to import, and things like --help, argument checks and dry runs never touch them
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
+
+torch        = _LazyModule('torch')
+einops       = _LazyModule('einops')
+diffusers    = _LazyModule('diffusers')
+transformers = _LazyModule('transformers')
+nw           = _LazyModule('rp.git.CommonSource.noise_warp')
+
+def __getattr__(name):
+    #dtype used to be a module global, made when torch was imported up front
+    if name == 'dtype':
+        return torch.bfloat16
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 pipe_ids = dict(
     T2V5B="THUDM/CogVideoX-5b",
@@ -30,7 +54,6 @@ lora_urls = dict(
     T2V5B_blendnorm_i25000_DATASET_nearest_lora_weights       = base_url+'T2V5B_blendnorm_i25000_DATASET_nearest_lora_weights.safetensors',
 )
 
-dtype=torch.bfloat16
 
 #https://medium.com/@ChatGLM/open-sourcing-cogvideox-a-step-towards-revolutionizing-video-generation-28fa4812699d
 B, F, C, H, W = 1, 13, 16, 60, 90  # The defaults
@@ -38,13 +61,129 @@ num_frames=(F-1)*4+1 #https://miro.medium.com/v2/resize:fit:1400/format:webp/0*z
 #Possible num_frames: 1, 5, 9, 13, 17, 21, 25, 29, 33, 37, 41, 45, 49
 assert num_frames==49
 
+#Ways to trade speed for memory in get_pipe, ordered fastest to slowest
+#    offload: None keeps everything on the device
+#             'model' moves whole models (text encoder, transformer, vae) onto the device only while they're used
+#             'sequential' streams individual layers onto the device as they run - the least memory, but by far the slowest
+#    vae_tiling and vae_slicing decode the video in tiles / one sample at a time, which lowers the decoding memory peak
+#There's no attention slicing: CogVideoXTransformer3DModel doesn't support it, so pipe.enable_attention_slicing() would silently do nothing
+#sequential_untiled is what low_vram=True has always meant. Tiled decoding gives slightly different videos, so it's only used when asked for
+#It's listed last because 'auto' takes the first profile that fits, and 'sequential' needs less memory
+memory_profiles = dict(
+    full               = dict(offload=None        , vae_tiling=False, vae_slicing=False),
+    full_tiled         = dict(offload=None        , vae_tiling=True , vae_slicing=True ),
+    model              = dict(offload='model'     , vae_tiling=True , vae_slicing=True ),
+    sequential         = dict(offload='sequential', vae_tiling=True , vae_slicing=True ),
+    sequential_untiled = dict(offload='sequential', vae_tiling=False, vae_slicing=False),
+)
+
+#Rough extra memory needed on top of the resident weights for a 49x480x720 generation, used by memory_profile='auto'
+#Untiled VAE decoding is what makes the difference
+activation_bytes = dict(
+    untiled = 10 * 1024**3,
+    tiled   =  4 * 1024**3,
+)
+
+def _get_module_bytes(module):
+    return sum(x.numel() * x.element_size() for x in module.parameters()) + sum(x.numel() * x.element_size() for x in module.buffers())
+
+def choose_memory_profile(pipe, device):
+    """
+    Picks the fastest of memory_profiles that should fit in the device's currently free memory
+    Returns the profile name and a dict of the estimates it was chosen from, so the choice can be reported
+    Only CUDA devices can be measured - the CPU always gets 'full', and other devices (like mps) get 'sequential' to be safe
+    """
+    device = torch.device(device)
+    modules = {name: module for name, module in pipe.components.items() if isinstance(module, torch.nn.Module)}
+    weight_bytes = {name: _get_module_bytes(module) for name, module in modules.items()}
+
+    if device.type == 'cpu':
+        return 'full', dict(reason='cpu')
+    if device.type != 'cuda':
+        return 'sequential', dict(reason=f"can't measure free memory on {device.type}")
+
+    free_bytes, total_bytes = torch.cuda.mem_get_info(device)
+
+    def get_required_bytes(profile):
+        settings = memory_profiles[profile]
+        activations = activation_bytes['tiled' if settings['vae_tiling'] else 'untiled']
+        if settings['offload'] is None:
+            return sum(weight_bytes.values()) + activations
+        if settings['offload'] == 'model':
+            return max(weight_bytes.values()) + activations
+        return activations
+
+    required_bytes = {profile: get_required_bytes(profile) for profile in memory_profiles}
+    estimates = dict(free_gib=free_bytes / 1024**3, required_gib={profile: x / 1024**3 for profile, x in required_bytes.items()})
+
+    for profile in memory_profiles:
+        if required_bytes[profile] <= free_bytes:
+            return profile, estimates
+
+    return 'sequential', estimates
+
+def apply_memory_profile(pipe, device, memory_profile):
+    settings = memory_profiles[memory_profile]
+
+    if settings['offload'] is None:
+        pipe = pipe.to(device)
+    elif settings['offload'] == 'model':
+        pipe = pipe.to('cpu')
+        pipe.enable_model_cpu_offload(device=device)
+    elif settings['offload'] == 'sequential':
+        pipe = pipe.to('cpu')
+        pipe.enable_sequential_cpu_offload(device=device)
+    else:
+        assert False, settings
+
+    if settings['vae_tiling']:
+        pipe.vae.enable_tiling()
+    if settings['vae_slicing']:
+        pipe.vae.enable_slicing()
+
+    return pipe
+
+fused_lora_folder = 'lora_models/fused'
+
+def get_fused_lora_path(lora_name):
+    #Where the transformer with lora_name fused into it gets cached, in diffusers' save_pretrained format (safetensors)
+    return rp.path_join(fused_lora_folder, lora_name)
+
+def save_fused_lora_transformer(transformer, lora_name):
+    #Saves to a temporary folder first, so a half-written cache is never mistaken for a finished one
+    #Each process gets its own temporary folder, since parallel sweep workers can all fuse the same LoRA at once
+    #Whichever finishes first wins - the others' copies are identical, so they're just discarded
+    fused_path = get_fused_lora_path(lora_name)
+    rp.make_directory(fused_lora_folder)
+    temp_path = tempfile.mkdtemp(dir=fused_lora_folder, prefix=lora_name + '.tmp.')
+    try:
+        transformer.save_pretrained(temp_path, safe_serialization=True)
+        if not rp.folder_exists(fused_path):
+            try:
+                os.replace(temp_path, fused_path)
+            except OSError:
+                if not rp.folder_exists(fused_path): #Another worker got there in between
+                    raise
+    finally:
+        if rp.folder_exists(temp_path):
+            shutil.rmtree(temp_path)
+    return fused_path
+
 @rp.memoized #Torch never manages to unload it from memory anyway
-def get_pipe(model_name, device=None, low_vram=True):
+def get_pipe(model_name, device=None, low_vram=True, memory_profile=None, fuse_lora=False):
     """
     model_name is like "I2V5B", "T2V2B", or "T2V5B", or a LoRA name like "T2V2B_RDeg_i30000_lora_weights"
     device is automatically selected if unspecified
-    low_vram, if True, will make the pipeline use CPU offloading
+    low_vram, if True, will make the pipeline use sequential CPU offloading without VAE tiling ('sequential_untiled'), like it always has. Otherwise it uses 'full'
+    memory_profile overrides low_vram if specified. It's either a key of memory_profiles ('full', 'full_tiled', 'model', 'sequential', 'sequential_untiled'),
+        or 'auto' to use the fastest one that fits in the device's free memory (see choose_memory_profile)
+        The profile that was used is stored in pipe.memory_profile
+    fuse_lora, if True, merges the LoRA into the transformer's weights so inference doesn't pay for the adapters
+        The fused transformer is cached in fused_lora_folder, and later calls load it directly (memory-mapped safetensors) instead of applying the LoRA again
     """
+    if memory_profile is None:
+        memory_profile = 'sequential_untiled' if low_vram else 'full'
+    assert memory_profile == 'auto' or memory_profile in memory_profiles, memory_profile
 
     if model_name in pipe_ids:
         lora_name = None
@@ -70,14 +209,21 @@ def get_pipe(model_name, device=None, low_vram=True):
     
     hub_model_id = pipe_ids[pipe_name]
 
-    transformer = CogVideoXTransformer3DModel.from_pretrained(hub_model_id, subfolder="transformer", torch_dtype=torch.bfloat16)
-    text_encoder = T5EncoderModel.from_pretrained(hub_model_id, subfolder="text_encoder", torch_dtype=torch.bfloat16)
-    vae = AutoencoderKLCogVideoX.from_pretrained(hub_model_id, subfolder="vae", torch_dtype=torch.bfloat16)
+    fused_path = get_fused_lora_path(lora_name) if fuse_lora and lora_name is not None else None
+    use_fused_cache = fused_path is not None and rp.folder_exists(fused_path)
+
+    if use_fused_cache:
+        print(f"\tLOADING FUSED LORA TRANSFORMER FROM {fused_path}")
+        transformer = diffusers.CogVideoXTransformer3DModel.from_pretrained(fused_path, torch_dtype=torch.bfloat16)
+    else:
+        transformer = diffusers.CogVideoXTransformer3DModel.from_pretrained(hub_model_id, subfolder="transformer", torch_dtype=torch.bfloat16)
+    text_encoder = transformers.T5EncoderModel.from_pretrained(hub_model_id, subfolder="text_encoder", torch_dtype=torch.bfloat16)
+    vae = diffusers.AutoencoderKLCogVideoX.from_pretrained(hub_model_id, subfolder="vae", torch_dtype=torch.bfloat16)
 
-    PipeClass = CogVideoXImageToVideoPipeline if is_i2v else CogVideoXPipeline
+    PipeClass = diffusers.CogVideoXImageToVideoPipeline if is_i2v else diffusers.CogVideoXPipeline
     pipe = PipeClass.from_pretrained(hub_model_id, torch_dtype=torch.bfloat16, vae=vae,transformer=transformer,text_encoder=text_encoder)
 
-    if lora_name is not None:
+    if lora_name is not None and not use_fused_cache:
         lora_folder = rp.make_directory('lora_models')
         lora_url = lora_urls[lora_name]
         lora_path = rp.download_url(lora_url, lora_folder, show_progress=True, skip_existing=True)
@@ -86,21 +232,25 @@ def get_pipe(model_name, device=None, low_vram=True):
         pipe.load_lora_weights(lora_path)
         print("DONE!")
 
+        if fuse_lora:
+            print(end="\tFUSING LORA WEIGHTS...",flush=True)
+            pipe.fuse_lora()
+            pipe.unload_lora_weights() #The fused weights stay - this just removes the adapters
+            rp.make_directory(fused_lora_folder)
+            print("DONE! Cached to " + save_fused_lora_transformer(pipe.transformer, lora_name))
+
     if device is None:
         device = rp.select_torch_device()
 
-    if not low_vram:
-        print("\tUSING PIPE DEVICE", device)
-        pipe = pipe.to(device)
-    else:
-        print("\tUSING PIPE DEVICE WITH CPU OFFLOADING",device)
-        pipe=pipe.to('cpu')
-        pipe.enable_sequential_cpu_offload(device=device)
+    if memory_profile == 'auto':
+        memory_profile, estimates = choose_memory_profile(pipe, device)
+        rp.fansi_print(f"\tAUTO MEMORY PROFILE: {memory_profile}    {estimates}", 'cyan', 'bold')
 
-    # pipe.vae.enable_tiling()
-    # pipe.vae.enable_slicing()
+    print(f"\tUSING PIPE DEVICE {device} WITH MEMORY PROFILE {memory_profile}: {memory_profiles[memory_profile]}")
+    pipe = apply_memory_profile(pipe, device, memory_profile)
 
     # Metadata
+    pipe.memory_profile = memory_profile
     pipe.lora_name = lora_name
     pipe.pipe_name = pipe_name
     pipe.is_i2v    = is_i2v
@@ -108,20 +258,151 @@ def get_pipe(model_name, device=None, low_vram=True):
     
     return pipe
 
-def get_downtemp_noise(noise, noise_downtemp_interp):
+def get_downtemp_noise(noise, noise_downtemp_interp, length=F):
     assert noise_downtemp_interp in {'nearest', 'blend', 'blend_norm', 'randn'}, noise_downtemp_interp
-    if   noise_downtemp_interp == 'nearest'    : return                  rp.resize_list(noise, 13)
-    elif noise_downtemp_interp == 'blend'      : return                   downsamp_mean(noise, 13)
-    elif noise_downtemp_interp == 'blend_norm' : return normalized_noises(downsamp_mean(noise, 13))
-    elif noise_downtemp_interp == 'randn'      : return torch.randn_like(rp.resize_list(noise, 13)) #Basically no warped noise, just r
-    else: assert False, 'impossible'
+    return resample_noise_temporally(noise, length, noise_downtemp_interp)
+
+noise_downtemp_interps = ('nearest', 'blend', 'blend_norm', 'randn')
+
+def resample_noise_temporally(noise, length, mode='nearest'):
+    """
+    Resamples warped noise along its time axis, using only whole-tensor ops (no python loops over frames)
+    Works on (T, C, H, W) or (B, T, C, H, W) tensors, on whatever device the noise lives on
+    Any source length T and target length can be used - not just 49 --> 13
+
+    Modes:
+        'nearest'    : Picks frames like rp.resize_list does (the first and last frames are always kept)
+        'blend'      : Averages contiguous chunks of frames, chunked like rp.split_into_n_sublists
+        'blend_norm' : Like 'blend', but renormalizes so the averaged noise has unit std again
+        'randn'      : Basically no warped noise - fresh gaussian noise with the shape 'nearest' would give
+
+    If length > T, 'blend' can't average anything, so each output frame is just its chunk's first frame
+
+    EXAMPLE:
+        >>> noise = torch.randn(49, 16, 60, 90)
+        >>> resample_noise_temporally(noise, 13, 'blend_norm').shape
+        ans = torch.Size([13, 16, 60, 90])
+        >>> resample_noise_temporally(noise[None].repeat(4,1,1,1,1), 7, 'nearest').shape
+        ans = torch.Size([4, 7, 16, 60, 90])
+    """
+    assert mode in noise_downtemp_interps, mode
+    assert noise.ndim in (4, 5), 'Expected (T, C, H, W) or (B, T, C, H, W) noise but got shape '+str(tuple(noise.shape))
+    assert length > 0, length
+
+    time_dim = noise.ndim - 4
+    T = noise.shape[time_dim]
+
+    if mode in ('nearest', 'randn'):
+        #Same indices as rp.resize_list: round(i * (T-1)/(length-1))
+        step = (T - 1) / (length - 1) if T > 1 and length > 1 else 0
+        indices = torch.round(torch.arange(length, dtype=torch.float64) * step).long().to(noise.device)
+        output = noise.index_select(time_dim, indices)
+        if mode == 'randn':
+            output = torch.randn_like(output)
+        return output
+
+    #Same chunks as rp.split_into_n_sublists: frames [int(i*T/length), int((i+1)*T/length))
+    #Expressed as a (length, T) averaging matrix so the whole thing is one einsum
+    bounds = torch.arange(length + 1, device=noise.device) * T // length
+    starts = bounds[:-1]
+    ends = torch.maximum(bounds[1:], starts + 1)
+    frames = torch.arange(T, device=noise.device)
+    membership = (frames[None] >= starts[:, None]) & (frames[None] < ends[:, None])
+    weights = membership.float() / membership.sum(1, keepdim=True)
+
+    output = torch.einsum('lt,...tchw->...lchw', weights, noise.float())
+
+    if mode == 'blend_norm':
+        #Matches the old per-frame x / x.std(1, keepdim=True) on each (C, H, W) frame
+        output = output / output.std(-2, keepdim=True)
+
+    return output.to(noise.dtype)
 
 def downsamp_mean(x, l=13):
-    return torch.stack([rp.mean(u) for u in rp.split_into_n_sublists(x, l)])
+    return resample_noise_temporally(x, l, 'blend')
 
 def normalized_noises(noises):
     #Noises is in TCHW form
-    return torch.stack([x / x.std(1, keepdim=True) for x in noises])
+    return noises / noises.std(-2, keepdim=True)
+
+
+def load_cartridge_video(video, root='.'):
+    """
+    Returns a cartridge's video as uint8 frames in F H W C form, which is what its consumers (the first frame image, previews) take directly
+    video can be a path to an mp4 (relative to root), uint8 frames in F C H W or F H W C form, or an older cartridge's [-1, 1] float tensor
+    """
+    if isinstance(video, str):
+        video = rp.load_video(rp.path_join(root, video), show_progress=False)
+
+    if isinstance(video, torch.Tensor):
+        if video.dtype != torch.uint8:
+            #Older cartridges stored (as_torch_images(frames)*2-1).bfloat16()
+            video = ((video.float() + 1) * 127.5).round().clamp(0, 255).to(torch.uint8)
+        video = video.numpy()
+
+    video = np.asarray(video)
+    assert video.dtype == np.uint8 and video.ndim == 4, (video.dtype, video.shape)
+    if video.shape[1] in (1, 3, 4) and video.shape[-1] not in (1, 3, 4):
+        video = einops.rearrange(video, 'F C H W -> F H W C')
+
+    return video[..., :3]
+
+
+#How a cartridge folder's noise can be stored. load_noise_file takes whichever of these it finds, in this order
+#The F C H W formats are already in the layout load_sample_cartridge uses, so the uncompressed ones are memory-mapped straight into torch
+noise_formats = dict(
+    bfloat16         = 'noises_fchw_bfloat16.npy',         #Stored as uint16 bit patterns, since numpy has no bfloat16
+    float16          = 'noises_fchw_float16.npy',
+    float16_chunked  = 'noises_fchw_float16_chunked.npz',  #Compressed in chunks of frames, for archiving datasets. Can't be memory-mapped
+    float32          = 'noises.npy',                       #F H W C, as written by nw.get_noise_from_video
+)
+
+def save_noise_file(noise, folder, noise_format='bfloat16', chunk_frames=7):
+    """
+    Saves (F, C, H, W) noise (a torch tensor or numpy array) to folder in one of the noise_formats, and returns the path
+    chunk_frames is how many frames go in each compressed chunk of the float16_chunked format
+    """
+    path = rp.path_join(rp.make_directory(folder), noise_formats[noise_format])
+    noise = torch.as_tensor(noise)
+    assert noise.ndim == 4, 'Expected (F, C, H, W) noise but got shape '+str(tuple(noise.shape))
+
+    if noise_format == 'bfloat16':
+        array = noise.to(torch.bfloat16).view(torch.int16).numpy().view(np.uint16)
+    elif noise_format == 'float32':
+        array = einops.rearrange(noise.float(), 'F C H W -> F H W C').numpy()
+    else:
+        array = noise.to(torch.float16).numpy()
+
+    if noise_format == 'float16_chunked':
+        chunks = {f'frames_{start:04}': array[start : start + chunk_frames] for start in range(0, len(array), chunk_frames)}
+        np.savez_compressed(path, **chunks)
+    else:
+        np.save(path, array)
+
+    return path
+
+def load_noise_file(folder):
+    """
+    Loads a cartridge folder's noise as an (F, C, H, W) tensor, from whichever of the noise_formats it has
+    The uncompressed F C H W formats are memory-mapped: nothing is read from disk until it's used, and nothing is copied
+    """
+    for noise_format, file_name in noise_formats.items():
+        path = rp.path_join(folder, file_name)
+        if rp.file_exists(path):
+            break
+    else:
+        raise FileNotFoundError(f"No noise file in {folder}. Expected one of: {', '.join(noise_formats.values())}")
+
+    if noise_format == 'float16_chunked':
+        with np.load(path) as chunks:
+            return torch.from_numpy(np.concatenate([chunks[key] for key in sorted(chunks.files)]))
+
+    array = np.load(path, mmap_mode='c') #Copy-on-write, so torch gets a writable array without a copy
+    if noise_format == 'bfloat16':
+        return torch.from_numpy(array.view(np.int16)).view(torch.bfloat16)
+    if noise_format == 'float32':
+        return einops.rearrange(torch.from_numpy(array), 'F H W C -> F C H W')
+    return torch.from_numpy(array)
 
 
 @rp.memoized
@@ -134,6 +415,7 @@ def load_sample_cartridge(
     #SETTINGS:
     num_inference_steps=30,
     guidance_scale=6,
+    step_reuse=0,
 ):
     """
     COMPLETELY FROM SAMPLE: Generate with /root/micromamba/envs/i2sb/lib/python3.8/site-packages/rp/git/CommonSource/notebooks/CogVidSampleGenerator.ipynb
@@ -153,20 +435,12 @@ def load_sample_cartridge(
         #Was generated using the flow pipeline
         print(end="LOADING CARTRIDGE FOLDER "+sample_path+"...")
         
-        noise_file=rp.path_join(sample_path,'noises.npy')
-        instance_noise = np.load(noise_file)
-        instance_noise = torch.tensor(instance_noise)
-        instance_noise = einops.rearrange(instance_noise, 'F H W C -> F C H W')
-
-        video_file=rp.path_join(sample_path,'input.mp4')
-        instance_video = rp.load_video(video_file)
-        instance_video = rp.as_torch_images(instance_video)
-        instance_video = instance_video * 2 - 1
+        instance_noise = load_noise_file(sample_path) #Memory-mapped when possible - see noise_formats
 
         sample = rp.as_easydict(
             instance_prompt = '', #Please have some prompt to override this! Ideally the defualt would come from a VLM
             instance_noise = instance_noise,
-            instance_video = instance_video,
+            instance_video = 'input.mp4', #Decoded straight to uint8 by load_cartridge_video
         )
 
         print("DONE!")
@@ -182,10 +456,11 @@ def load_sample_cartridge(
     #    >>> list(sample)?s                 -->  ['instance_prompt', 'instance_video', 'instance_noise']
     #    >>> sample.instance_prompt?s       -->  A group of elk, including a dominant bull, is seen grazing and moving through...
     #    >>> sample.instance_noise.shape?s  -->  torch.Size([49, 16,  60,  90])
-    #    >>> sample.instance_video.shape?s  -->  torch.Size([49,  3, 480, 720])   # Range: [-1, 1]
+    #    >>> sample.instance_video.shape?s  -->  torch.Size([49,  3, 480, 720])   # Range: [-1, 1] in older cartridges, uint8 in newer ones
+    #Newer cartridges can also store instance_video as the path to an mp4, relative to the cartridge
 
-    sample_noise  = sample["instance_noise" ].to(dtype)
-    sample_video  = sample["instance_video" ].to(dtype)
+    sample_noise  = sample["instance_noise" ].to(torch.bfloat16)
+    sample_video  = load_cartridge_video(sample["instance_video"], sample_path if rp.is_a_folder(sample_path) else os.path.dirname(sample_path))
     sample_prompt = sample["instance_prompt"]
 
     sample_gif_path = sample_path+'.mp4'
@@ -197,7 +472,7 @@ def load_sample_cartridge(
         sample_gif_path = sample_path+'.mp4'
 
         rp.fansi_print("MAKING SAMPLE PREVIEW VIDEO",'light blue green','underlined')
-        preview_sample_video=rp.as_numpy_images(sample_video)/2+.5
+        preview_sample_video=rp.as_float_images(sample_video)
         preview_sample_noise=rp.as_numpy_images(sample_noise)[:,:,:,:3]/5+.5
         preview_sample_noise = rp.resize_images(preview_sample_noise, size=8, interp="nearest")
         preview_sample=rp.horizontally_concatenated_videos(preview_sample_video,preview_sample_noise)
@@ -214,12 +489,12 @@ def load_sample_cartridge(
 
     assert downtemp_noise.shape == (B, F, C, H, W), (downtemp_noise.shape,(B, F, C, H, W))
 
-    if image is None            : sample_image = rp.as_pil_image(rp.as_numpy_image(sample_video[0].float()/2+.5))
+    if image is None            : sample_image = rp.as_pil_image(sample_video[0])
     elif isinstance(image, str) : sample_image = rp.as_pil_image(rp.as_rgb_image(rp.load_image(image)))
     else                        : sample_image = rp.as_pil_image(rp.as_rgb_image(image))
 
     metadata = rp.gather_vars('sample_path degradation downtemp_noise sample_gif_path sample_video sample_noise noise_downtemp_interp')
-    settings = rp.gather_vars('num_inference_steps guidance_scale'+0*'v2v_strength')
+    settings = rp.gather_vars('num_inference_steps guidance_scale step_reuse'+0*'v2v_strength')
 
     if noise  is None: noise  = downtemp_noise
     if video  is None: video  = sample_video
@@ -287,6 +562,7 @@ def get_output_path(pipe, cartridge, subfolder:str, output_root:str):
             degrad   =               cartridge.metadata.degradation,
             downtemp =               cartridge.metadata.noise_downtemp_interp,
             samp     = rp.get_file_name(rp.get_parent_folder(cartridge.metadata.sample_path), False),
+            **(dict(reuse=cartridge.settings.step_reuse) if cartridge.settings.step_reuse else {}),
         )
         + ".mp4"
     )
@@ -304,76 +580,700 @@ def get_output_path(pipe, cartridge, subfolder:str, output_root:str):
 
     return output_path
 
+#Decoded + resized preview videos, keyed by (path, mtime, length). Sweeps reuse the same cartridge over and over,
+#so without this run_pipe would decode the same sample preview from disk for every single output.
+#Least recently used entries are evicted once the total exceeds PREVIEW_CACHE_MAX_BYTES
+PREVIEW_CACHE_MAX_BYTES = 2 * 1024**3
+_preview_cache = OrderedDict()
+
+def _preview_cache_nbytes():
+    #Unpadded left panels are the very same arrays as their decoded videos, so don't count them twice
+    return sum(x.nbytes for x in {id(x): x for x in _preview_cache.values()}.values())
+
+def _preview_cache_get(key, make):
+    if key in _preview_cache:
+        _preview_cache.move_to_end(key)
+        return _preview_cache[key]
+
+    value = make()
+    value.flags.writeable = False #Shared between outputs - nobody should modify it in place
+    _preview_cache[key] = value
+
+    while len(_preview_cache) > 1 and _preview_cache_nbytes() > PREVIEW_CACHE_MAX_BYTES:
+        _preview_cache.popitem(last=False)
+
+    return value
+
+def clear_preview_cache():
+    _preview_cache.clear()
+
+def load_preview_video(path, length):
+    """
+    Loads a sample preview video as a (length, H, W, 3) uint8 numpy array, resized to length frames like rp.resize_list
+    Decoded frames are cached in memory - editing the file on disk invalidates its entry because the mtime is part of the key
+    """
+    key = ('video', os.path.abspath(path), os.path.getmtime(path), length)
+
+    def make():
+        frames = rp.load_video(path, show_progress=False)
+        frames = rp.resize_list(frames, length)
+        return rp.as_numpy_array(rp.as_byte_images(rp.as_rgb_images(frames)))
+
+    return _preview_cache_get(key, make)
+
+def _pad_video_height(video, height):
+    #Pads the top of the frames with black so the bottoms line up - like origin='bottom right' in rp.horizontally_concatenated_videos
+    T, H, W, C = video.shape
+    if H >= height:
+        return video
+    return np.concatenate([np.zeros((T, height - H, W, C), video.dtype), video], axis=1)
+
+def load_preview_left_panel(path, length, height):
+    """
+    The left half of a side-by-side preview: the sample preview video, padded to the given height
+    Cached alongside the decoded frames, so every output in a sweep that uses the same cartridge shares one copy
+    """
+    key = ('left_panel', os.path.abspath(path), os.path.getmtime(path), length, height)
+    return _preview_cache_get(key, lambda: _pad_video_height(load_preview_video(path, length), height))
+
+def make_labeled_preview(video, sample_gif_path, label):
+    """
+    Puts the sample preview to the left of the generated video, and writes the label above them
+    video is a THWC numpy video. The label is rendered once and stacked onto every frame, instead of once per frame.
+    """
+    video = rp.as_numpy_array(rp.as_byte_images(rp.as_rgb_images(video)))
+
+    T, H = len(video), video.shape[1]
+    left_panel = load_preview_left_panel(sample_gif_path, T, H)
+    height = max(H, left_panel.shape[1])
+
+    prevideo = np.concatenate(
+        [
+            _pad_video_height(left_panel, height),
+            _pad_video_height(video, height),
+        ],
+        axis=2,
+    )
+
+    labeled_frame = rp.labeled_image(
+        prevideo[0],
+        label,
+        position="top",
+        size_by_lines=True,
+        text_color='light light light blue',
+        # font='G:Lexend'
+    )
+    labeled_frame = rp.as_byte_image(rp.as_rgb_image(labeled_frame))
+    label_strip = labeled_frame[: len(labeled_frame) - height]
+    assert label_strip.shape[1:] == prevideo.shape[2:], (label_strip.shape, prevideo.shape)
+
+    return np.concatenate([np.broadcast_to(label_strip, (T,) + label_strip.shape), prevideo], axis=1)
+
+#VAE-encoded I2V images, keyed by image content and VAE identity. Sweeps over degradation, guidance_scale or LoRA
+#keep conditioning on the same image, so without this every output would VAE-encode it again (and with sequential
+#offload, stream the whole VAE encoder onto the device to do so). We store the latent distribution's parameters rather
+#than a sample, so the pipeline still draws its own sample from them exactly like it would have without the cache.
+#Least recently used entries are evicted once the total exceeds IMAGE_LATENT_CACHE_MAX_BYTES
+#If IMAGE_LATENT_CACHE_FOLDER (or run_pipe's image_latent_cache_folder, or main's --image_latent_cache_folder) is set, entries are also
+#saved there - so they survive restarts and are shared between sweep workers. Workers are spawned, so they only see the folder main passes them
+IMAGE_LATENT_CACHE_MAX_BYTES = 256 * 1024**2
+IMAGE_LATENT_CACHE_FOLDER = None
+_image_latent_cache = OrderedDict()
+
+def clear_image_latent_cache():
+    _image_latent_cache.clear()
+
+#VAE attributes that change what encode returns, not just how fast. Tiled encoding (which 480x720 images trigger) gives different latents,
+#and the memory profiles turn tiling and slicing on and off - so latents from one profile mustn't be served to another
+vae_encode_attributes = [
+    'use_tiling',
+    'use_slicing',
+    'tile_sample_min_height',
+    'tile_sample_min_width',
+    'tile_overlap_factor_height',
+    'tile_overlap_factor_width',
+]
+
+def get_vae_identity(vae):
+    #VAEs that weren't loaded from anywhere can't be told apart by name, so those only match themselves
+    name = vae.config.get('_name_or_path') or f"unsaved-{id(vae)}"
+    encode_settings = ",".join(f"{key}={getattr(vae, key, None)}" for key in vae_encode_attributes)
+    return f"{type(vae).__name__}:{name}:{vae.dtype}:{encode_settings}"
+
+def get_image_latent_key(vae, image):
+    image = image.detach().cpu().contiguous()
+    hasher = hashlib.sha256()
+    hasher.update(f"{get_vae_identity(vae)}:{tuple(image.shape)}:{image.dtype}".encode())
+    hasher.update(image.view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
+
+def get_image_latent_parameters(vae, image, encode, cache_folder=None):
+    """
+    Returns the VAE's latent distribution parameters for an image tensor, only calling encode(image) on a cache miss
+    The parameters are kept on the CPU - callers move them to wherever they're needed
+    """
+    key = get_image_latent_key(vae, image)
+
+    if key in _image_latent_cache:
+        _image_latent_cache.move_to_end(key)
+        return _image_latent_cache[key]
+
+    cache_path = cache_folder and rp.path_join(cache_folder, key + '.pt')
+    if cache_path and rp.file_exists(cache_path):
+        parameters = torch.load(cache_path)
+    else:
+        parameters = encode(image).latent_dist.parameters.detach().cpu()
+        if cache_path:
+            #Sweep workers (and gradio's generation threads) can encode the same image at once, so each writes its own temporary file
+            rp.make_directory(cache_folder)
+            temp_file, temp_path = tempfile.mkstemp(dir=cache_folder, prefix=key + '.', suffix='.tmp')
+            os.close(temp_file)
+            torch.save(parameters, temp_path)
+            os.replace(temp_path, cache_path)
+
+    _image_latent_cache[key] = parameters
+    while len(_image_latent_cache) > 1 and sum(x.nbytes for x in _image_latent_cache.values()) > IMAGE_LATENT_CACHE_MAX_BYTES:
+        _image_latent_cache.popitem(last=False)
+
+    return parameters
+
+@contextlib.contextmanager
+def cached_image_latents(pipe, cache_folder=None):
+    """
+    While active, pipe.vae.encode answers from the image latent cache, so the pipeline gets precomputed conditioning latents
+    The I2V pipeline only ever encodes the conditioning image, so nothing else is affected
+    """
+    from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+    from diffusers.models.modeling_outputs import AutoencoderKLOutput
+
+    vae = pipe.vae
+    encode = vae.encode
+
+    def cached_encode(x, return_dict=True):
+        parameters = get_image_latent_parameters(vae, x, encode, cache_folder)
+        latent_dist = DiagonalGaussianDistribution(parameters.to(device=x.device))
+        return AutoencoderKLOutput(latent_dist=latent_dist) if return_dict else (latent_dist,)
+
+    vae.encode = cached_encode
+    try:
+        yield
+    finally:
+        del vae.encode #Falls back to the class's method again
+
+
+#Step reuse: consecutive diffusion steps often feed the transformer nearly the same input, especially with warped noise,
+#so its output barely changes either. step_reuse tracks the relative L1 change of the transformer's input since the last step
+#it actually ran, and while that stays under the threshold, reuses the last output (extrapolated from the last two) instead.
+#The threshold is the quality/speed knob: 0 runs every step, and bigger values skip more steps at some cost in quality.
+@contextlib.contextmanager
+def step_reuse(transformer, threshold, num_steps=None, extrapolate=True):
+    """
+    While active, transformer(...) may return a reused output instead of running. Yields stats with computed and reused step counts
+    The first two steps and step num_steps (the last one) always run. Works with any transformer whose first argument is hidden_states
+    and that returns (output,) or an object with .sample, like CogVideoXTransformer3DModel
+    """
+    from diffusers.models.modeling_outputs import Transformer2DModelOutput
+
+    forward = transformer.forward
+    had_own_forward = 'forward' in transformer.__dict__ #Offload hooks replace forward on the instance
+    stats = rp.as_easydict(computed=0, reused=0, threshold=threshold)
+    state = rp.as_easydict(step=0, previous_input=None, change=0.0, outputs=[])
+
+    def reusing_forward(hidden_states, *args, return_dict=True, **kwargs):
+        step = state.step
+        state.step += 1
+
+        if state.previous_input is not None:
+            previous = state.previous_input
+            state.change += ((hidden_states - previous).abs().mean() / previous.abs().mean().clamp(min=1e-8)).item()
+        state.previous_input = hidden_states
+
+        must_run = len(state.outputs) < 2 or step + 1 == num_steps or state.change >= threshold
+        if must_run:
+            output = forward(hidden_states, *args, return_dict=False, **kwargs)[0]
+            state.outputs = state.outputs[-1:] + [(step, output)]
+            state.change = 0.0
+            stats.computed += 1
+        else:
+            (older_step, older), (last_step, last) = state.outputs
+            output = last
+            if extrapolate:
+                output = last + (last - older) * ((step - last_step) / (last_step - older_step))
+            stats.reused += 1
+
+        return Transformer2DModelOutput(sample=output) if return_dict else (output,)
+
+    transformer.forward = reusing_forward
+    try:
+        yield stats
+    finally:
+        if had_own_forward:
+            transformer.forward = forward
+        else:
+            del transformer.forward
+
+
+class GenerationCancelled(Exception):
+    #Raised from inside the pipeline when run_pipe's should_cancel() returns True, so the job stops without running its remaining steps or decoding
+    pass
+
+def fit_latent_rgb_projection(pipe, image, height, width):
+    """
+    Least-squares fits a linear map from latent channels (plus a bias) to RGB, from one image and its VAE encoding
+    Returns a (C+1, 3) tensor. It's only an approximation, but it's plenty to judge motion and composition from intermediate latents.
+    The image is preprocessed exactly like the I2V pipeline does it, so its encoding comes straight from the image latent cache
+    """
+    x = pipe.video_processor.preprocess(image, height=height, width=width).to(pipe._execution_device, dtype=torch.bfloat16)
+    latent = pipe.vae.encode(x.unsqueeze(2)).latent_dist.mean[:, :, 0]
+    if getattr(pipe.vae.config, 'invert_scale_latents', False):
+        latent = latent / pipe.vae.config.scaling_factor
+    else:
+        latent = latent * pipe.vae.config.scaling_factor
+
+    rgb = torch.nn.functional.interpolate(x.float(), size=latent.shape[-2:], mode='area') / 2 + .5
+
+    inputs = einops.rearrange(latent.float().cpu(), '1 C h w -> (h w) C')
+    inputs = torch.cat([inputs, torch.ones(len(inputs), 1)], dim=1)
+    targets = einops.rearrange(rgb.cpu(), '1 C h w -> (h w) C')
+    return torch.linalg.lstsq(inputs, targets).solution
+
+def latents_to_rgb_preview(latents, projection):
+    #latents is (B, F, C, h, w). Returns the first video's (F, h, w, 3) uint8 frames - no VAE involved
+    latents = einops.rearrange(latents[0].float().cpu(), 'F C h w -> F h w C')
+    rgb = latents @ projection[:-1] + projection[-1]
+    return (rgb.clamp(0, 1) * 255).round().byte().numpy()
+
+def save_progress_preview(path, scale=4, length=num_frames, framerate=8):
+    """
+    Returns an on_preview(frames, step) for run_pipe that keeps path updated with the latest preview
+    Frames are stretched to the output's length and framerate so the preview plays at the same speed
+    """
+    def on_preview(frames, step):
+        frames = rp.resize_list(rp.resize_images(frames, size=scale, interp='nearest'), length)
+        temp_path = rp.save_video_mp4(frames, path + '.tmp.mp4', framerate=framerate, show_progress=False)
+        os.replace(temp_path, path)
+        print(f"Step {step} preview: {path}")
+    return on_preview
+
+def make_step_callback(image, preview_every=None, on_preview=None, should_cancel=None):
+    """
+    Returns a callback_on_step_end for the pipeline
+    Every preview_every steps it calls on_preview(frames, step) with frames from latents_to_rgb_preview,
+    and after every step it raises GenerationCancelled if should_cancel() says so
+    image is what the latent to RGB projection gets fitted to, the first time it's needed
+    """
+    projection = []
+
+    def callback(pipe, step, timestep, callback_kwargs):
+        if should_cancel is not None and should_cancel():
+            raise GenerationCancelled(f"Cancelled after step {step + 1}")
+
+        if preview_every and on_preview is not None and (step + 1) % preview_every == 0:
+            latents = callback_kwargs['latents']
+            if not projection:
+                scale = pipe.vae_scale_factor_spatial
+                projection.append(fit_latent_rgb_projection(pipe, image, latents.shape[-2] * scale, latents.shape[-1] * scale))
+            on_preview(latents_to_rgb_preview(latents, projection[0]), step + 1)
+
+        return {}
+
+    return callback
+
+
 def run_pipe(
     pipe,
     cartridge,
     subfolder="first_subfolder",
     output_root: str = "infer_outputs",
     output_mp4_path = None, #This overrides subfolder and output_root if specified
+    preview_every = None, #If specified, makes a cheap preview from the latents every this many steps (see make_step_callback)
+    on_preview = None, #Gets each preview as on_preview(frames, step). Defaults to saving output_mp4_path + "_progress.mp4"
+    should_cancel = None, #If specified, called after every step. Returning True ends the job by raising GenerationCancelled
+    save_previews = True, #If False, skips the labeled preview MP4s and GIF, and their paths are None
+    image_latent_cache_folder = None, #Where to also keep encoded I2V images on disk. Defaults to IMAGE_LATENT_CACHE_FOLDER
 ):
     # output_mp4_path = output_mp4_path or get_output_path(pipe, cartridge, subfolder, output_root)
 
     if rp.file_exists(output_mp4_path):
         raise RuntimeError("{output_mp4_path} already exists! Please choose a different output file or delete that one. This script is designed not to clobber previous results.")
     
-    if pipe.is_i2v:
-        image = cartridge.image
-        if isinstance(image, str):
-            image = rp.load_image(image,use_cache=True)
-        image = rp.as_pil_image(rp.as_rgb_image(image))
+    #T2V pipes don't take an image, but the preview projection is still fitted to it
+    image = cartridge.image
+    if isinstance(image, str):
+        image = rp.load_image(image,use_cache=True)
+    image = rp.as_pil_image(rp.as_rgb_image(image))
+
+    if preview_every and on_preview is None:
+        on_preview = save_progress_preview(output_mp4_path + "_progress.mp4")
 
     # if pipe.is_v2v:
     #     print("Making v2v video...")
-    #     v2v_video=cartridge.video
-    #     v2v_video=rp.as_numpy_images(v2v_video) / 2 + .5
-    #     v2v_video=rp.as_pil_images(v2v_video)
+    #     v2v_video=rp.as_pil_images(cartridge.video) #Already uint8 F H W C
 
     print("NOISE SHAPE",cartridge.noise.shape)
     print("IMAGE",image)
 
-    video = pipe(
-        prompt=cartridge.prompt,
-        **(dict(image   =image                          ) if pipe.is_i2v else {}),
-        # **(dict(strength=cartridge.settings.v2v_strength) if pipe.is_v2v else {}),
-        # **(dict(video   =v2v_video                      ) if pipe.is_v2v else {}),
-        num_inference_steps=cartridge.settings.num_inference_steps,
-        latents=cartridge.noise,
+    num_steps = cartridge.settings.num_inference_steps
+    reuse_threshold = cartridge.settings.get('step_reuse') or 0
+    if reuse_threshold > 0:
+        reuse_context = step_reuse(pipe.transformer, reuse_threshold, num_steps)
+    else:
+        #Leave the transformer alone, so the default path doesn't pay for measuring how much its inputs change
+        reuse_context = contextlib.nullcontext(rp.as_easydict(computed=num_steps, reused=0, threshold=0))
+    with cached_image_latents(pipe, image_latent_cache_folder or IMAGE_LATENT_CACHE_FOLDER), reuse_context as step_stats:
+        video = pipe(
+            prompt=cartridge.prompt,
+            **(dict(image   =image                          ) if pipe.is_i2v else {}),
+            # **(dict(strength=cartridge.settings.v2v_strength) if pipe.is_v2v else {}),
+            # **(dict(video   =v2v_video                      ) if pipe.is_v2v else {}),
+            num_inference_steps=num_steps,
+            latents=cartridge.noise,
+
+            guidance_scale=cartridge.settings.guidance_scale,
+            callback_on_step_end=make_step_callback(image, preview_every, on_preview, should_cancel),
+            # generator=torch.Generator(device=device).manual_seed(42),
+        ).frames[0]
+
+    if step_stats.reused:
+        rp.fansi_print(f"STEP REUSE: ran the transformer on {step_stats.computed} of {num_steps} steps (threshold={step_stats.threshold})", "cyan", "bold")
+
+    diffusers.utils.export_to_video(video, output_mp4_path, fps=8)
 
-        guidance_scale=cartridge.settings.guidance_scale,
-        # generator=torch.Generator(device=device).manual_seed(42),
-    ).frames[0]
+    video=rp.as_numpy_images(video)
+    preview_mp4_path = compressed_preview_mp4_path = preview_gif_path = None
+    if save_previews:
+        prevideo = make_labeled_preview(
+            video,
+            sample_gif_path=cartridge.metadata.sample_gif_path,
+            label=cartridge.metadata.sample_path +"\n"+output_mp4_path +"\n\n" + rp.wrap_string_to_width(cartridge.prompt, 250),
+        )
 
-    export_to_video(video, output_mp4_path, fps=8)
+        preview_mp4_path = output_mp4_path + "_preview.mp4"
+        preview_gif_path = preview_mp4_path + ".gif"
+        print(end=f"Saving preview MP4 to preview_mp4_path = {preview_mp4_path}...")
+        rp.save_video_mp4(prevideo, preview_mp4_path, framerate=16, video_bitrate="max", show_progress=False)
+        compressed_preview_mp4_path = rp.save_video_mp4(prevideo, output_mp4_path + "_preview_compressed.mp4", framerate=16, show_progress=False)
+        print("done!")
+        print(end=f"Saving preview gif to preview_gif_path = {preview_gif_path}...")
+        rp.convert_to_gif_via_ffmpeg(preview_mp4_path, preview_gif_path, framerate=12,show_progress=False)
+        print("done!")
 
-    sample_gif=rp.load_video(cartridge.metadata.sample_gif_path)
-    video=rp.as_numpy_images(video)
-    prevideo = rp.horizontally_concatenated_videos(
-        rp.resize_list(sample_gif, len(video)),
-        video,
-        origin='bottom right',
-    )
-    import textwrap
-    prevideo = rp.labeled_images(
-        prevideo,
-        position="top",
-        labels=cartridge.metadata.sample_path +"\n"+output_mp4_path +"\n\n" + rp.wrap_string_to_width(cartridge.prompt, 250),
-        size_by_lines=True,
-        text_color='light light light blue',
-        # font='G:Lexend'
+    return rp.gather_vars('video output_mp4_path preview_mp4_path compressed_preview_mp4_path cartridge subfolder preview_mp4_path preview_gif_path step_stats')
+
+
+def _as_manifest_value(value):
+    #Things like PIL images can't go in a JSON file, so record what they were instead
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return repr(value)
+
+#Opt-in settings added after manifests already existed. Left out of a job's params while they're off, so those jobs keep their ids
+opt_in_settings = dict(step_reuse=0)
+
+def get_sweep_jobs(cartridge_kwargs, model_name):
+    """
+    Turns the broadcasted cartridge kwargs into a list of sweep jobs
+    A job's job_id is a hash of its fully resolved parameters, so the same job gets the same id after a restart
+    """
+    jobs = []
+    for kwargs in cartridge_kwargs:
+        params = {key: _as_manifest_value(value) for key, value in dict(kwargs, model_name=model_name).items()}
+        params = {key: value for key, value in params.items() if key not in opt_in_settings or value != opt_in_settings[key]}
+        job_id = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+        jobs.append(rp.as_easydict(job_id=job_id, params=params, cartridge_kwargs=dict(kwargs)))
+    return jobs
+
+def check_sweep_jobs(jobs, model_name, memory_profile=None):
+    """
+    Catches bad arguments before any models are loaded, so a typo fails in a fraction of a second instead of after minutes of loading
+    Raises a ValueError listing every problem found
+    """
+    problems = []
+
+    if model_name not in pipe_ids and model_name not in lora_urls:
+        problems.append(f"Unknown model_name={model_name!r}. Options: {', '.join([*pipe_ids, *lora_urls])}")
+    if memory_profile is not None and memory_profile != 'auto' and memory_profile not in memory_profiles:
+        problems.append(f"Unknown memory_profile={memory_profile!r}. Options: auto, {', '.join(memory_profiles)}")
+
+    for job in jobs:
+        kwargs = job.cartridge_kwargs
+        if not rp.path_exists(kwargs['sample_path']):
+            problems.append(f"sample_path={kwargs['sample_path']!r} doesn't exist")
+        if kwargs['noise_downtemp_interp'] not in noise_downtemp_interps:
+            problems.append(f"Unknown noise_downtemp_interp={kwargs['noise_downtemp_interp']!r}. Options: {', '.join(noise_downtemp_interps)}")
+        if isinstance(kwargs['image'], str) and not rp.is_valid_url(kwargs['image']) and not rp.file_exists(kwargs['image']):
+            problems.append(f"image={kwargs['image']!r} doesn't exist")
+        if not 0 <= kwargs['degradation'] <= 1:
+            problems.append(f"degradation={kwargs['degradation']!r} should be between 0 and 1")
+        if kwargs['step_reuse'] < 0:
+            problems.append(f"step_reuse={kwargs['step_reuse']!r} can't be negative")
+
+    if problems:
+        raise ValueError("Invalid arguments:\n    " + "\n    ".join(rp.unique(problems)))
+
+def load_manifest(manifest_path, resume=True):
+    """
+    A sweep manifest is a JSON file that records every job's parameters, status, output paths and timings
+    It's rewritten after every status change, so if the process dies mid-sweep, rerunning the same command picks up where it left off
+    """
+    if resume and rp.file_exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = rp.as_easydict(json.load(file))
+        rp.fansi_print(f"Resuming sweep from manifest {rp.fansi_highlight_path(manifest_path)}", "cyan", "bold")
+    else:
+        manifest = rp.as_easydict(jobs={})
+    return manifest
+
+def save_manifest(manifest, manifest_path):
+    #Write then rename, so getting killed mid-write never leaves a half-written manifest behind
+    rp.make_directory(os.path.dirname(manifest_path) or ".")
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(temp_path, manifest_path)
+
+def is_job_done(entry):
+    return entry.get("status") == "done" and rp.file_exists(entry.get("output_mp4_path") or "")
+
+def get_job_output_path(pipe, cartridge, output_mp4_path, num_jobs):
+    """
+    A sweep with one job writes straight to output_mp4_path
+    Otherwise each job gets its own file in a folder named after output_mp4_path, named after its settings by get_output_path
+    """
+    if num_jobs == 1:
+        return output_mp4_path
+    output_root = os.path.dirname(output_mp4_path) or "."
+    subfolder = rp.get_file_name(output_mp4_path, False)
+    return get_output_path(pipe, cartridge, subfolder=subfolder, output_root=output_root)
+
+run_outputs = [
+    "output_mp4_path",
+    "preview_mp4_path",
+    "compressed_preview_mp4_path",
+    "preview_gif_path",
+]
+
+#Files run_pipe writes next to output_mp4_path, named by appending these to it
+run_output_suffixes = [
+    "_preview.mp4",
+    "_preview_compressed.mp4",
+    "_preview.mp4.gif",
+    "_progress.mp4",
+    "_progress.mp4.tmp.mp4",
+]
+
+def remove_partial_outputs(entry):
+    #If an earlier attempt at this job died partway through, it may have left some of its outputs behind
+    #They have to go, because run_pipe refuses to overwrite existing files
+    #Only output_mp4_path is recorded before run_pipe starts, so the files derived from it are found by name
+    #execute_sweep_job only records output_mp4_path if nothing was there yet, and only files written since that attempt started
+    #are deleted - so files the sweep didn't make (like a user's earlier result with the same name) are never touched
+    paths = [entry.get(key) for key in run_outputs]
+    if entry.get("output_mp4_path"):
+        paths += [entry["output_mp4_path"] + suffix for suffix in run_output_suffixes]
+    started_at = entry.get("started_at")
+    for path in paths:
+        #File times come from a coarser clock than time.time(), so allow a second of slack
+        if path and rp.file_exists(path) and started_at is not None and os.path.getmtime(path) >= started_at - 1:
+            os.remove(path)
+
+def execute_sweep_job(pipe, job, output_mp4_path, num_jobs, on_update, run_pipe_kwargs=None):
+    """
+    Runs one job of a sweep on the given pipe
+    Progress is reported by calling on_update(**fields) with the manifest fields that changed,
+    so the caller decides where they go - straight into the manifest, or back to the scheduler from a worker process
+    run_pipe_kwargs are extra arguments for run_pipe, like image_latent_cache_folder or save_previews
+    If the job fails, on_update gets status='failed' before the error is re-raised
+    """
+    on_update(status="running", started_at=time.time(), error=None)
+
+    try:
+        start_time = time.time()
+        cartridge = load_sample_cartridge(**job.cartridge_kwargs)
+        job_output_mp4_path = get_job_output_path(pipe, cartridge, output_mp4_path, num_jobs)
+        if rp.file_exists(job_output_mp4_path):
+            #Checked before the path goes in the manifest, so a resumed sweep never mistakes this file for one of its own partial outputs
+            raise RuntimeError(f"{job_output_mp4_path} already exists! Please choose a different output file or delete that one. This script is designed not to clobber previous results.")
+        on_update(
+            load_seconds=time.time() - start_time,
+            resolved_prompt=cartridge.prompt,
+            output_mp4_path=job_output_mp4_path,
+        )
+
+        start_time = time.time()
+        pipe_out = run_pipe(
+            pipe=pipe,
+            cartridge=cartridge,
+            output_mp4_path=job_output_mp4_path,
+            **(run_pipe_kwargs or {}),
+        )
+        run_seconds = time.time() - start_time
+
+    except BaseException as error:
+        on_update(status="failed", error=repr(error), finished_at=time.time())
+        raise
+
+    on_update(
+        **rp.gather(pipe_out, run_outputs, as_dict=True),
+        run_seconds=run_seconds,
+        steps_computed=pipe_out.step_stats.computed,
+        steps_reused=pipe_out.step_stats.reused,
+        status="done",
+        finished_at=time.time(),
     )
 
-    preview_mp4_path = output_mp4_path + "_preview.mp4"
-    preview_gif_path = preview_mp4_path + ".gif"
-    print(end=f"Saving preview MP4 to preview_mp4_path = {preview_mp4_path}...")
-    rp.save_video_mp4(prevideo, preview_mp4_path, framerate=16, video_bitrate="max", show_progress=False)
-    compressed_preview_mp4_path = rp.save_video_mp4(prevideo, output_mp4_path + "_preview_compressed.mp4", framerate=16, show_progress=False)
-    print("done!")
-    print(end=f"Saving preview gif to preview_gif_path = {preview_gif_path}...")
-    rp.convert_to_gif_via_ffmpeg(preview_mp4_path, preview_gif_path, framerate=12,show_progress=False)
-    print("done!")
+def run_sweep_job(pipe, job, manifest, manifest_path, output_mp4_path, num_jobs, run_pipe_kwargs=None):
+    """
+    Runs one job of a sweep in this process, recording its progress in the manifest as it goes
+    """
+    entry = manifest.jobs[job.job_id]
+    remove_partial_outputs(entry)
+
+    def on_update(**fields):
+        entry.update(fields)
+        save_manifest(manifest, manifest_path)
 
-    return rp.gather_vars('video output_mp4_path preview_mp4_path compressed_preview_mp4_path cartridge subfolder preview_mp4_path preview_gif_path')
+    execute_sweep_job(pipe, job, output_mp4_path, num_jobs, on_update, run_pipe_kwargs)
 
+    return entry
+
+def get_sweep_devices(devices='all', num_workers=None):
+    """
+    Decides which devices the sweep's worker processes run on - one worker per entry in the returned list
+        devices='all' uses every CUDA device, or num_workers CPU workers if there are none
+        devices can also be a list like ['cuda:0', 'cuda:2'], or a comma-separated string like 'cuda:0,cuda:2'
+    """
+    if isinstance(devices, str) and devices != 'all':
+        devices = devices.split(',')
+
+    if devices == 'all':
+        if torch.cuda.is_available():
+            devices = ['cuda:%i' % i for i in range(torch.cuda.device_count())]
+        else:
+            devices = ['cpu'] * (num_workers or 1)
+
+    devices = [str(device) for device in devices]
+    assert devices, 'There must be at least one device to run the sweep on'
+    return devices
+
+def _sweep_worker(worker_index, device, model_name, low_vram, memory_profile, fuse_lora, pipe_factory, output_mp4_path, num_jobs, run_pipe_kwargs, job_queue, result_queue):
+    #Runs in its own process. Loads one resident pipe, then keeps pulling jobs off the shared queue until it gets None
+    #Every message is (worker_index, job_id, fields), so the scheduler knows which job a worker had if it dies
+    try:
+        pipe = (pipe_factory or get_pipe)(model_name, device, low_vram=low_vram, memory_profile=memory_profile, fuse_lora=fuse_lora)
+    except BaseException as error:
+        result_queue.put((worker_index, None, dict(worker_error=repr(error), device=device)))
+        raise
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+
+        def on_update(**fields):
+            result_queue.put((worker_index, job.job_id, dict(fields, device=device)))
+
+        try:
+            execute_sweep_job(pipe, job, output_mp4_path, num_jobs, on_update, run_pipe_kwargs)
+        except Exception:
+            pass #Already reported as failed through on_update - move on to the next job
+
+def run_sweep_parallel(pending_jobs, manifest, manifest_path, output_mp4_path, num_jobs, model_name, devices, low_vram=True, memory_profile=None, fuse_lora=False, pipe_factory=None, run_pipe_kwargs=None):
+    """
+    Spreads the pending jobs over one worker process per device, each holding its own pipe from get_pipe
+    Workers pull jobs from a shared queue, and only this process writes the manifest
+    Unlike the serial loop in main, a failed job doesn't stop the others - the failures are raised together at the end
+
+    pipe_factory replaces get_pipe in the workers, and has the same signature: pipe_factory(model_name, device, low_vram=low_vram, memory_profile=memory_profile, fuse_lora=fuse_lora)
+    It has to be picklable (a top level function), because workers are started with 'spawn'
+    This is how the scheduler can be tried out on CPU with a tiny stand-in model - see benchmark_throughput.py --workers
+    run_pipe_kwargs are passed on to every run_pipe call, so they have to be picklable too
+    """
+    import multiprocessing
+    import queue
+
+    for job in pending_jobs:
+        remove_partial_outputs(manifest.jobs[job.job_id])
+
+    context = multiprocessing.get_context('spawn') #CUDA can't be used in forked processes
+    job_queue = context.Queue()
+    result_queue = context.Queue()
+
+    for job in pending_jobs:
+        job_queue.put(job)
+    for _ in devices:
+        job_queue.put(None)
+
+    rp.fansi_print(f"Running {len(pending_jobs)} jobs on {len(devices)} workers: {devices}", "cyan", "bold")
+    workers = [
+        context.Process(
+            target=_sweep_worker,
+            args=(worker_index, device, model_name, low_vram, memory_profile, fuse_lora, pipe_factory, output_mp4_path, num_jobs, run_pipe_kwargs, job_queue, result_queue),
+            daemon=True,
+        )
+        for worker_index, device in enumerate(devices)
+    ]
+    for worker in workers:
+        worker.start()
+
+    remaining = {job.job_id for job in pending_jobs}
+    failed = []
+    current_jobs = {} #worker_index -> the job it's running
+
+    def handle_message(worker_index, job_id, fields):
+        if job_id is None:
+            rp.fansi_print(f"Sweep worker on {fields['device']} failed to start: {fields['worker_error']}", "red", "bold")
+            return
+
+        manifest.jobs[job_id].update(fields)
+        save_manifest(manifest, manifest_path)
+
+        if fields.get("status") == "running":
+            current_jobs[worker_index] = job_id
+        elif fields.get("status") in ("done", "failed"):
+            current_jobs.pop(worker_index, None)
+            remaining.discard(job_id)
+            if fields["status"] == "failed":
+                failed.append(job_id)
+
+    while remaining:
+        try:
+            handle_message(*result_queue.get(timeout=1))
+            continue
+        except queue.Empty:
+            pass
+
+        dead_workers = [worker_index for worker_index, worker in enumerate(workers) if worker.exitcode is not None]
+        if not dead_workers:
+            continue
+
+        #A worker may have sent its last updates right before exiting - read them before deciding what it left unfinished
+        while True:
+            try:
+                handle_message(*result_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        #A worker that died mid-job (killed, out of memory...) never reports that job. Fail it now instead of when the whole sweep ends
+        for worker_index in dead_workers:
+            if worker_index in current_jobs:
+                exitcode = workers[worker_index].exitcode
+                handle_message(worker_index, current_jobs[worker_index], dict(
+                    status="failed",
+                    error=f"Sweep worker on {devices[worker_index]} exited with code {exitcode} during this job",
+                    finished_at=time.time(),
+                ))
+
+        if remaining and len(dead_workers) == len(workers):
+            raise RuntimeError(f"All sweep workers exited with {len(remaining)} jobs left unfinished. Rerun to resume them.")
+
+    for worker in workers:
+        worker.join()
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(pending_jobs)} sweep jobs failed: " + ", ".join(manifest.jobs[job_id].error for job_id in failed))
 
 # #prompt = "A little girl is riding a bicycle at high speed. Focused, detailed, realistic."
 # prompt = "An old house by the lake with wooden plank siding and a thatched roof"
@@ -392,6 +1292,8 @@ def main(
     model_name='I2V5B_final_i38800_nearest_lora_weights',
 
     low_vram=True,
+    memory_profile:str=None,
+    fuse_lora=False,
     device:str=None,
     
     #BROADCASTABLE:
@@ -399,7 +1301,15 @@ def main(
     image=None,
     num_inference_steps=30,
     guidance_scale=6,
+    step_reuse=0,
     # v2v_strength=.5,#Timestep for when using Vid2Vid. Only set to not none when using a T2V model!
+
+    manifest_path:str=None,
+    resume=True,
+    devices=None,
+    num_workers:int=None,
+    image_latent_cache_folder:str=None,
+    dry_run=False,
 ):
     """
     Main function to run the video generation pipeline with specified parameters.
@@ -408,19 +1318,25 @@ def main(
         model_name (str): Name of the pipeline to use ('T2V5B', 'T2V2B', 'I2V5B', etc).
         device (str or int, optional): Device to run the model on (e.g., 'cuda:0' or 0). If unspecified, the GPU with the  most free VRAM will be chosen.
         low_vram (bool): Set to True if you have less than 32GB of VRAM. In enables model cpu offloading, which slows down inference but needs much less vram.
+        memory_profile (str, optional): Overrides low_vram. One of 'full', 'full_tiled', 'model', 'sequential', 'sequential_untiled', or 'auto' to pick the fastest one that fits in free VRAM. See memory_profiles.
+        fuse_lora (bool): Fuse the LoRA into the transformer and cache the result on disk, so later runs skip loading the LoRA and inference skips the adapters.
         sample_path (str or list, optional): Broadcastable. Path(s) to the sample `.pkl` file(s) or folders containing (noise.npy and input.mp4 files)
         degradation (float or list): Broadcastable. Degradation level(s) for the noise warp (float between 0 and 1).
         noise_downtemp_interp (str or list): Broadcastable. Interpolation method(s) for down-temporal noise. Options: 'nearest', 'blend', 'blend_norm'.
         image (str, PIL.Image, or list, optional): Broadcastable. Image(s) to use as the initial frame(s). Can be a URL or a path to an image.
         prompt (str or list, optional): Broadcastable. Text prompt(s) for video generation.
         num_inference_steps (int or list): Broadcastable. Number of inference steps for the pipeline.
+        step_reuse (float or list): Broadcastable. If nonzero, skips transformer steps whose input changed less than this much (relative L1, accumulated) since the last step that ran, reusing its output. Around .05 to .2 is a good range. See step_reuse.
+        output_mp4_path (str): Where to save the video. If more than one job is broadcast, each job saves to its own uniquely named file in a folder named after this path instead.
+        manifest_path (str, optional): Where to keep the sweep manifest, which records every job's parameters, status, outputs and timings. Defaults to output_mp4_path + '.manifest.json'
+        resume (bool): If True and the manifest already exists, jobs it lists as done are skipped and the rest are run. If False, the manifest starts over.
+        devices (str or list, optional): If specified, the jobs are spread over one worker process per device instead of running one after another on `device`. 'all' uses every GPU (see get_sweep_devices).
+        num_workers (int, optional): How many CPU worker processes to use when there are no GPUs. Implies devices='all'.
+        image_latent_cache_folder (str, optional): Also keeps the VAE-encoded I2V images in this folder, so they're shared between workers and later runs. Defaults to IMAGE_LATENT_CACHE_FOLDER.
+        dry_run (bool): If True, just checks the arguments and prints which jobs would run, without loading any models or writing anything.
     """
-    output_root='infer_outputs', # output_root (str): Root directory where output videos will be saved.
-    subfolder='default_subfolder', # subfolder (str): Subfolder within output_root to save outputs.
-
-    if device is None:
-        device = rp.select_torch_device(reserve=True, prefer_used=True)
-        rp.fansi_print(f"Selected torch device: {device}")
+    if manifest_path is None:
+        manifest_path = output_mp4_path + ".manifest.json"
 
 
     cartridge_kwargs = rp.broadcast_kwargs(
@@ -432,6 +1348,7 @@ def main(
             "prompt",
             "num_inference_steps",
             "guidance_scale",
+            "step_reuse",
             # "v2v_strength",
         )
     )
@@ -449,36 +1366,53 @@ def main(
         ),
     )
 
-    # cartridges = [load_sample_cartridge(**x) for x in cartridge_kwargs]
-    cartridges = rp.load_files(lambda x:load_sample_cartridge(**x), cartridge_kwargs, show_progress='eta:Loading Cartridges')
+    jobs = get_sweep_jobs(cartridge_kwargs, model_name)
+    check_sweep_jobs(jobs, model_name, memory_profile)
 
-    pipe = get_pipe(model_name, device, low_vram=low_vram)
+    manifest = load_manifest(manifest_path, resume=resume)
+    for job in jobs:
+        manifest.jobs.setdefault(job.job_id, rp.as_easydict(params=job.params, status="pending"))
 
-    output=[]
-    for cartridge in cartridges:
-        pipe_out = run_pipe(
-            pipe=pipe,
-            cartridge=cartridge,
-            output_root=output_root,
-            subfolder=subfolder,
-            output_mp4_path=output_mp4_path,
-        )
+    pending_jobs = [job for job in jobs if not is_job_done(manifest.jobs[job.job_id])]
 
-        output.append(
-            rp.as_easydict(
-                rp.gather(
-                    pipe_out,
-                    [
-                        "output_mp4_path",
-                        "preview_mp4_path",
-                        "compressed_preview_mp4_path",
-                        "preview_mp4_path",
-                        "preview_gif_path",
-                    ],
-                    as_dict=True,
-                )
-            )
-        )
+    if dry_run:
+        pending_ids = {job.job_id for job in pending_jobs}
+        for job in jobs:
+            action = "run " if job.job_id in pending_ids else "skip"
+            print(f"{action}  {job.job_id}  {manifest.jobs[job.job_id].status:8}  {json.dumps(job.params)}")
+        rp.fansi_print(f"DRY RUN: {len(pending_jobs)} of {len(jobs)} jobs would run. Manifest: {manifest_path}", "cyan", "bold")
+        return [rp.as_easydict(job_id=job.job_id, status=manifest.jobs[job.job_id].status, params=job.params) for job in jobs]
+
+    save_manifest(manifest, manifest_path)
+
+    if len(pending_jobs) < len(jobs):
+        rp.fansi_print(f"Skipping {len(jobs)-len(pending_jobs)} of {len(jobs)} jobs that are already done", "cyan", "bold")
+
+    #Resolved here, since spawned workers re-import this module
+    run_pipe_kwargs = dict(image_latent_cache_folder=image_latent_cache_folder or IMAGE_LATENT_CACHE_FOLDER)
+
+    if devices is not None or num_workers is not None:
+        devices = get_sweep_devices(devices or 'all', num_workers)
+        if len(devices) == 1:
+            device = devices[0]
+
+    if pending_jobs and devices is not None and len(devices) > 1:
+        run_sweep_parallel(pending_jobs, manifest, manifest_path, output_mp4_path, len(jobs), model_name, devices, low_vram=low_vram, memory_profile=memory_profile, fuse_lora=fuse_lora, run_pipe_kwargs=run_pipe_kwargs)
+
+    elif pending_jobs:
+        if device is None:
+            device = rp.select_torch_device(reserve=True, prefer_used=True)
+            rp.fansi_print(f"Selected torch device: {device}")
+
+        pipe = get_pipe(model_name, device, low_vram=low_vram, memory_profile=memory_profile, fuse_lora=fuse_lora)
+
+        for job in pending_jobs:
+            run_sweep_job(pipe, job, manifest, manifest_path, output_mp4_path, num_jobs=len(jobs), run_pipe_kwargs=run_pipe_kwargs)
+
+    output = [
+        rp.as_easydict(rp.gather(manifest.jobs[job.job_id], run_outputs, as_dict=True))
+        for job in jobs
+    ]
     return output
 
 if __name__ == '__main__':
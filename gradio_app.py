@@ -5,30 +5,96 @@ import shutil
 import subprocess
 import numpy as np
 import cv2
-from PIL import Image
+from PIL import Image, ImageOps
 import sys
+import time
+import hashlib
+import queue
+import threading
+import itertools
+from easydict import EasyDict
+
+# Heavy dependencies (torch, diffusers) are only imported once the first job runs
+import cut_and_drag_inference as inference
+
+# Generation settings
+MODEL_NAME = "I2V5B_final_i38800_nearest_lora_weights"
+GENERATION_DEVICES = [None]  # One worker and one resident pipeline per entry. None picks a free GPU automatically
+MAX_QUEUED_JOBS = 8          # Clicks beyond this are turned away instead of piling up
+PREVIEW_EVERY = 5            # Show a cheap latent preview every this many diffusion steps
+
+# Workspace settings
+WORKSPACE_ROOT = Path("workspace")
+WORKSPACE_MAX_BYTES = 20 * 1024**3  # Least recently used workspaces are deleted once they add up to more than this
+
+def hash_file(path):
+    """Hex digest of a file's contents"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def get_directory_bytes(directory):
+    """Total size of every file under a directory"""
+    return sum(path.stat().st_size for path in Path(directory).rglob("*") if path.is_file())
+
+def collect_workspace_garbage(max_bytes=WORKSPACE_MAX_BYTES, keep=()):
+    """
+    Deletes the least recently used workspaces until they all fit in max_bytes
+    Only content-addressed workspaces (the ones with a .last_used file) are ever deleted, and never the ones in keep
+    Returns the workspaces that were deleted
+    """
+    keep = {Path(workspace_dir).resolve() for workspace_dir in keep}
+    workspaces = sorted(
+        (marker.stat().st_mtime, marker.parent) for marker in WORKSPACE_ROOT.glob("*/.last_used")
+    )
+    sizes = {workspace_dir: get_directory_bytes(workspace_dir) for _, workspace_dir in workspaces}
+    total = sum(sizes.values())
+
+    deleted = []
+    for _, workspace_dir in workspaces:
+        if total <= max_bytes:
+            break
+        if workspace_dir.resolve() in keep:
+            continue
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+        total -= sizes[workspace_dir]
+        deleted.append(workspace_dir)
+    return deleted
 
 def ensure_workspace_structure(image_path):
-    """Create workspace directory structure for an image"""
-    # Get base name of image without extension
-    base_name = Path(image_path).stem
+    """
+    Get the workspace directory structure for an image, creating it if needed
+    Workspaces are named after the image's content hash, so the same image always gets the same workspace and
+    everything already made in it (resized image, inpainted backgrounds, layer renders, noise, cartridges, videos) is reused
+    """
+    image_hash = hash_file(image_path)[:16]
     
     # Create workspace directory structure
-    workspace_dir = Path("workspace") / base_name
+    workspace_dir = WORKSPACE_ROOT / image_hash
     data_dir = workspace_dir / "data"
     output_dir = workspace_dir / "output"
     
-    # If directories exist, remove them and recreate
-    if workspace_dir.exists():
-        shutil.rmtree(workspace_dir)
-    
-    # Create fresh directories
-    data_dir.mkdir(parents=True)
-    output_dir.mkdir(parents=True)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
     
     # Copy original image to data directory
     image_ext = Path(image_path).suffix
-    shutil.copy2(image_path, data_dir / f"original{image_ext}")
+    original_path = data_dir / f"original{image_ext}"
+    if not original_path.exists():
+        shutil.copy2(image_path, original_path)
+    
+    # The first frame at CogVideoX's resolution: resized to cover 720x480 then center-cropped, like the Cut-and-Drag GUI does
+    resized_path = data_dir / "resized_720x480.png"
+    if not resized_path.exists():
+        resized = ImageOps.fit(Image.open(image_path).convert("RGB"), (720, 480), method=Image.LANCZOS)
+        resized.save(resized_path)
+    
+    # Marks this workspace as recently used for the garbage collector
+    (workspace_dir / ".last_used").touch()
+    busy_workspaces = [Path(job.output_mp4_path).parent.parent for job in list(_jobs.values()) if not job.done.is_set()]
+    collect_workspace_garbage(keep=[workspace_dir, *busy_workspaces])
     
     return workspace_dir, data_dir, output_dir
 
@@ -48,16 +114,19 @@ def run_cut_and_drag(image, state):
             "original_image": image
         }
         
-        # Launch the cut_and_drag_gui.py in a separate process
+        # Launch the cut_and_drag_gui.py in a separate process. It saves its cartridge into output_dir
         process = subprocess.Popen([
             sys.executable,
             "cut_and_drag_gui.py",
-            image
+            str(data_dir / "resized_720x480.png"),
+            str(output_dir),
         ])
         
+        cartridge_path = find_cartridge(output_dir)
         steps = [
-            f"✓ Created workspace at {workspace_dir}",
+            f"✓ Using workspace at {workspace_dir}",
             f"✓ Saved original image to {data_dir}",
+            *([f"✓ Found an earlier cartridge for this image: {cartridge_path}"] if cartridge_path else []),
             "✓ Launched Cut-and-Drag GUI window",
             "Please use the GUI window that opened to:",
             "  1. Select polygon regions",
@@ -69,20 +138,166 @@ def run_cut_and_drag(image, state):
     except Exception as e:
         return f"Error: {str(e)}", None
 
-def placeholder_text_to_video(prompt, state):
+# In-process generation queue
+# Every job runs on a worker thread that owns one device. Pipelines stay loaded between jobs (get_pipe is memoized),
+# so clicks never reload the model, and at most len(GENERATION_DEVICES) jobs run at once no matter how many people click
+_job_queue = queue.Queue(maxsize=MAX_QUEUED_JOBS)
+_jobs = {}
+_job_ids = itertools.count(1)
+_workers = []
+_workers_lock = threading.Lock()
+
+def _generation_worker(device):
+    """Runs queued jobs one at a time on the given device, forever"""
+    while True:
+        job = _job_queue.get()
+        if job.cancel.is_set():
+            job.status = "cancelled"
+            job.done.set()
+            continue
+
+        job.status = "loading model"
+        job.started_at = time.time()
+        try:
+            pipe = inference.get_pipe(MODEL_NAME, device, memory_profile="auto")
+            cartridge = inference.load_sample_cartridge(
+                sample_path=job.cartridge_path,
+                degradation=job.degradation,
+                prompt=job.prompt,
+                num_inference_steps=job.num_inference_steps,
+            )
+            save_preview = inference.save_progress_preview(job.output_mp4_path + "_progress.mp4")
+
+            def on_preview(frames, step):
+                save_preview(frames, step)
+                job.preview_path = job.output_mp4_path + "_progress.mp4"
+                job.step = step
+
+            job.status = "generating"
+            inference.run_pipe(
+                pipe,
+                cartridge,
+                output_mp4_path=job.output_mp4_path,
+                preview_every=PREVIEW_EVERY,
+                on_preview=on_preview,
+                should_cancel=job.cancel.is_set,
+            )
+            job.status = "done"
+        except inference.GenerationCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = repr(e)
+        finally:
+            job.finished_at = time.time()
+            job.done.set()
+
+def _ensure_workers():
+    """Starts the worker threads the first time a job is submitted"""
+    with _workers_lock:
+        if not _workers:
+            for device in GENERATION_DEVICES:
+                worker = threading.Thread(target=_generation_worker, args=(device,), daemon=True)
+                worker.start()
+                _workers.append(worker)
+
+def find_cartridge(output_dir):
+    """Returns the newest cartridge the Cut-and-Drag GUI saved under output_dir, or None"""
+    cartridges = sorted(Path(output_dir).rglob("*_cartridge.pkl"), key=lambda path: path.stat().st_mtime)
+    return str(cartridges[-1]) if cartridges else None
+
+def get_generation_output_path(cartridge_path, prompt, degradation, num_inference_steps, output_dir):
+    """Videos are named after everything that went into them, so asking for the same video twice finds the first one"""
+    inputs = repr((hash_file(cartridge_path), prompt, float(degradation), int(num_inference_steps), MODEL_NAME))
+    return str(Path(output_dir) / f"generated_{hashlib.sha256(inputs.encode()).hexdigest()[:16]}.mp4")
+
+def submit_generation_job(cartridge_path, prompt, degradation, num_inference_steps, output_dir):
+    """Queues a generation job and returns it. Raises queue.Full if too many jobs are already waiting"""
+    _ensure_workers()
+
+    job_id = next(_job_ids)
+    job = EasyDict(
+        job_id=job_id,
+        cartridge_path=cartridge_path,
+        prompt=prompt,
+        degradation=degradation,
+        num_inference_steps=int(num_inference_steps),
+        output_mp4_path=get_generation_output_path(cartridge_path, prompt, degradation, num_inference_steps, output_dir),
+        status="queued",
+        step=0,
+        preview_path=None,
+        error=None,
+        submitted_at=time.time(),
+        cancel=threading.Event(),
+        done=threading.Event(),
+    )
+    _job_queue.put_nowait(job)
+    _jobs[job_id] = job
+    return job
+
+def describe_job(job):
+    """One line of status text for the UI"""
+    if job.status == "queued":
+        ahead = sum(other.status == "queued" and other.job_id < job.job_id for other in list(_jobs.values()))
+        return f"Job {job.job_id}: queued ({ahead} ahead of it)"
+    if job.status == "generating":
+        return f"Job {job.job_id}: generating, step {job.step} of {job.num_inference_steps}"
+    if job.status == "done":
+        return f"Job {job.job_id}: done in {job.finished_at - job.started_at:.0f}s. Saved to {job.output_mp4_path}"
+    if job.status == "failed":
+        return f"Job {job.job_id}: failed: {job.error}"
+    return f"Job {job.job_id}: {job.status}"
+
+def text_to_video(prompt, degradation, num_inference_steps, state):
+    """Generator for the Generate button: queues a job, then streams its status and previews until it finishes"""
     if not prompt:
-        return "Please enter a prompt first."
-    
+        yield "Please enter a prompt first.", None, None, state
+        return
+
     if not state or "workspace_dir" not in state:
-        return "Please complete the Cut-and-Drag process first."
-    
-    steps = [
-        f"Using workspace: {state['workspace_dir']}",
-        f"Using original image: {state['original_image']}",
-        f"Would process prompt: {prompt}"
-    ]
-    
-    return "\n".join(steps)
+        yield "Please complete the Cut-and-Drag process first.", None, None, state
+        return
+
+    cartridge_path = find_cartridge(state["output_dir"])
+    if cartridge_path is None:
+        yield "No cartridge found yet. Finish the Cut-and-Drag GUI (it saves one when you're done) and try again.", None, None, state
+        return
+
+    output_mp4_path = get_generation_output_path(cartridge_path, prompt, degradation, num_inference_steps, state["output_dir"])
+    if Path(output_mp4_path).exists():
+        yield f"Already generated with these settings: {output_mp4_path}", None, output_mp4_path, state
+        return
+
+    # If the same video is already queued or running, follow that job instead of making it twice
+    job = next((job for job in list(_jobs.values()) if job.output_mp4_path == output_mp4_path and not job.done.is_set()), None)
+    if job is None:
+        try:
+            job = submit_generation_job(cartridge_path, prompt, degradation, num_inference_steps, state["output_dir"])
+        except queue.Full:
+            yield f"The queue is full ({MAX_QUEUED_JOBS} jobs waiting). Please try again later.", None, None, state
+            return
+
+    state = dict(state, job_id=job.job_id)
+    shown_preview = None
+    while not job.done.wait(timeout=1):
+        if job.preview_path != shown_preview:
+            shown_preview = job.preview_path
+            yield describe_job(job), shown_preview, None, state
+        else:
+            yield describe_job(job), gr.update(), None, state
+
+    output = job.output_mp4_path if job.status == "done" else None
+    yield describe_job(job), job.preview_path, output, state
+
+def cancel_text_to_video(state):
+    """Cancels this session's most recent job. A running job stops after its current diffusion step"""
+    if not state or "job_id" not in state or state["job_id"] not in _jobs:
+        return "No job to cancel."
+    job = _jobs[state["job_id"]]
+    if job.done.is_set():
+        return describe_job(job)
+    job.cancel.set()
+    return f"Job {job.job_id}: cancelling..."
 
 # Create Gradio interface
 with gr.Blocks(title="Go-with-the-Flow") as demo:
@@ -125,11 +340,19 @@ with gr.Blocks(title="Go-with-the-Flow") as demo:
                     placeholder="Enter a detailed description of the video you want to create..."
                 )
                 
+                degradation_input = gr.Slider(0, 1, value=0.5, step=0.05, label="Degradation")
+                steps_input = gr.Slider(5, 50, value=30, step=1, label="Inference Steps")
+                
                 gr.Markdown("### 2. Generate")
-                btn2 = gr.Button("Generate Video")
+                with gr.Row():
+                    btn2 = gr.Button("Generate Video")
+                    cancel_btn = gr.Button("Cancel")
                 
                 gr.Markdown("### 3. Status")
                 output_text2 = gr.Textbox(label="Progress", lines=3)
+            with gr.Column():
+                preview_video = gr.Video(label="Preview (approximate)")
+                output_video = gr.Video(label="Generated Video")
                 
         gr.Markdown("---")
         gr.Markdown("""
@@ -144,14 +367,20 @@ with gr.Blocks(title="Go-with-the-Flow") as demo:
         outputs=[output_text1, state]
     )
     btn2.click(
-        fn=placeholder_text_to_video,
-        inputs=[prompt_input, state],
+        fn=text_to_video,
+        inputs=[prompt_input, degradation_input, steps_input, state],
+        outputs=[output_text2, preview_video, output_video, state],
+        concurrency_limit=None,  # Our own job queue limits how many generations run at once
+    )
+    cancel_btn.click(
+        fn=cancel_text_to_video,
+        inputs=[state],
         outputs=output_text2
     )
 
 if __name__ == "__main__":
     # Ensure workspace directory exists
-    Path("workspace").mkdir(exist_ok=True)
+    WORKSPACE_ROOT.mkdir(exist_ok=True)
     
     # Launch the interface
     # This will start a local server and automatically open the interface in your default web browser
@@ -11,22 +11,31 @@ import rp
 
 rp.r._pip_import_autoyes=True #Automatically install missing packages
 
-rp.pip_import('fire')
-rp.git_import('CommonSource') #If missing, installs code from https://github.com/RyannDaGreat/CommonSource
-import rp.git.CommonSource.noise_warp as nw
-import fire
+#The noise warping code (and the torch it needs) is only imported once main knows its arguments are good,
+#so --help and bad arguments return right away instead of after seconds of imports
 
-def main(video:str, output_folder:str):
+def main(video:str, output_folder:str, noise_format:str='float32'):
     """
     Takes a video URL or filepath and an output folder path
     It then resizes that video to height=480, width=720, 49 frames (CogVidX's dimensions)
     Then it calculates warped noise at latent resolution (i.e. 1/8 of the width and height) with 16 channels
     It saves that warped noise, optical flows, and related preview videos and images to the output folder
     The main file you need is <output_folder>/noises.npy which is the gaussian noises in (H,W,C) form
+    noise_format can instead be 'bfloat16' or 'float16' for a half-size (F,C,H,W) file that loads memory-mapped,
+    or 'float16_chunked' for a compressed one to archive. It replaces noises.npy - see noise_formats in cut_and_drag_inference.py
     """
+    from cut_and_drag_inference import noise_formats, save_noise_file
+
+    if noise_format not in noise_formats:
+        raise RuntimeError(f"The given noise_format={repr(noise_format)} isn't one of {list(noise_formats)}")
 
     if rp.folder_exists(output_folder):
         raise RuntimeError(f"The given output_folder={repr(output_folder)} already exists! To avoid clobbering what might be in there, please specify a folder that doesn't exist so I can create one for you. Alternatively, you could delete that folder if you don't care whats in it.")
+    if isinstance(video,str) and not rp.file_exists(video) and not rp.is_valid_url(video):
+        raise RuntimeError(f"The given video={repr(video)} is neither a file nor a URL")
+
+    rp.git_import('CommonSource') #If missing, installs code from https://github.com/RyannDaGreat/CommonSource
+    import rp.git.CommonSource.noise_warp as nw
 
     FRAME = 2**-1 #We immediately resize the input frames by this factor, before calculating optical flow
                   #The flow is calulated at (input size) × FRAME resolution.
@@ -75,6 +84,12 @@ def main(video:str, output_folder:str):
 
     rp.save_video_mp4(video, rp.path_join(output_folder, 'input.mp4'), framerate=12, video_bitrate='max')
 
+    if noise_format != 'float32':
+        float32_noise_path = rp.path_join(output_folder, noise_formats['float32'])
+        noise_path = save_noise_file(rp.as_numpy_array(output.numpy_noises).transpose(0, 3, 1, 2), output_folder, noise_format)
+        rp.delete_file(float32_noise_path)
+        print("Saved noise:", noise_path)
+
     #output.numpy_noises_downsampled = as_numpy_images(
         #nw.resize_noise(
             #as_torch_images(x),
@@ -90,4 +105,6 @@ def main(video:str, output_folder:str):
     print("Output folder:",output.output_folder)
 
 if __name__ == "__main__":
+    rp.pip_import('fire')
+    import fire
     fire.Fire(main) 